@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import time
 import threading
 import logging
 
+from itertools import islice
+from concurrent import futures
 from concurrent.futures import ThreadPoolExecutor
+from future.utils import iteritems
 
 from infinispan import hotrod
+from infinispan import codec
 from infinispan import connection
 from infinispan import error
+from infinispan import hashing
 from infinispan import utils
 from infinispan import serial
 from infinispan.async import generate_async, op
@@ -15,6 +21,15 @@ from infinispan.hotrod import Status, Flag, ClientIntelligence
 
 log = logging.getLogger(__name__)
 
+# requests that can be safely sent again if their connection breaks
+_IDEMPOTENT = frozenset([
+    hotrod.GetRequest, hotrod.GetWithVersionRequest,
+    hotrod.GetWithMetadataRequest, hotrod.ContainsKeyRequest,
+    hotrod.PutRequest, hotrod.RemoveRequest,
+    hotrod.ReplaceIfUnmodifiedRequest, hotrod.RemoveIfUnmodifiedRequest,
+    hotrod.PingRequest, hotrod.StatsRequest, hotrod.GetAllRequest,
+    hotrod.PutAllRequest])
+
 
 @generate_async
 class Infinispan(object):
@@ -38,7 +53,10 @@ class Infinispan(object):
 
     def __init__(self, host="127.0.0.1", port=11222, timeout=10,
                  cache_name=None, key_serial=None, val_serial=None,
-                 pool_size=20):
+                 pool_size=20, conn_pool_min=1, conn_pool_max=1,
+                 conn_max_pending=None, conn_options=None,
+                 conn_strategy=None, intelligence=ClientIntelligence.HASH,
+                 retry_policy=None):
         """Initializes new client instance.
 
         :param host: IP address of the host where Infinispan server is running.
@@ -55,19 +73,52 @@ class Infinispan(object):
         :param val_serial: Same as key_serial, but for value.
         :param pool_size: Determines the thread pool size that is used for
                           async operations.
+        :param conn_pool_min: Number of sockets kept open to every server node.
+        :param conn_pool_max: Maximum number of sockets opened to every server
+                              node, more sockets are opened only when all of
+                              them are busy.
+        :param conn_max_pending: Maximum number of requests sharing one socket
+                                 at once, unlimited by default. Use 1 for
+                                 exclusive use of a socket by one request.
+        :param conn_options: Keyword arguments of
+                             :class:`infinispan.connection.SocketConnection`
+                             applied to every socket, e.g. ``nodelay``,
+                             ``keepalive`` or ``connect_timeout``.
+        :param conn_strategy: Strategy selecting server nodes for requests,
+                              e.g. :class:`infinispan.connection.LeastPending`.
+                              Round-robin by default.
+        :param intelligence: Client intelligence, see
+                             :class:`infinispan.hotrod.ClientIntelligence`.
+                             With hash intelligence (the default), requests
+                             with a key are sent to the key's owner.
+        :param retry_policy: Policy of retrying idempotent operations (reads,
+                             :meth:`put`, :meth:`remove` and version
+                             conditional operations) on another connection
+                             when their connection breaks, see
+                             :class:`infinispan.connection.RetryPolicy`.
         """
 
         log.info("Initializing client with host=%r, port=%r, timeout=%r, "
-                 "cache_name=%r, key_serial=%r, val_serial=%r, pool_size=%r",
-                 host, port, timeout, cache_name, key_serial, val_serial,
-                 pool_size)
+                 "cache_name=%r, key_serial=%r, val_serial=%r, pool_size=%r, "
+                 "conn_pool_min=%r, conn_pool_max=%r, conn_max_pending=%r, "
+                 "conn_options=%r, conn_strategy=%r, intelligence=%r, "
+                 "retry_policy=%r", host, port, timeout, cache_name,
+                 key_serial, val_serial, pool_size, conn_pool_min,
+                 conn_pool_max, conn_max_pending, conn_options,
+                 conn_strategy, intelligence, retry_policy)
 
         self.conn_type = connection.SocketConnection
-        conn = connection.ConnectionPool(connections=[
-            self.conn_type(host, port, timeout=timeout)])
-        self.protocol = hotrod.Protocol(conn, timeout=timeout)
+        self.conn_options = dict(conn_options or {}, timeout=timeout)
+        conn = connection.ConnectionPool(
+            connections=[self.conn_type(host, port, **self.conn_options)],
+            min_size=conn_pool_min, max_size=conn_pool_max,
+            max_pending=conn_max_pending, wait_timeout=timeout,
+            health_check=self._check_health, strategy=conn_strategy)
+        self.protocol = hotrod.Protocol(
+            conn, timeout=timeout, intelligence=intelligence)
         self.cache_name = cache_name
-        self.ci = ClientIntelligence.TOPOLOGY
+        self.ci = intelligence
+        self.retry_policy = retry_policy or connection.RetryPolicy()
 
         self.key_serial = key_serial if key_serial else serial.JSONPickle()
         self.val_serial = val_serial if val_serial else serial.JSONPickle()
@@ -76,6 +127,10 @@ class Infinispan(object):
 
         self._lock = threading.Lock()
         self._curr_topology_id = 0
+        # maps keys to their owners, known only with hash intelligence
+        self._consistent_hash = None
+        # pre-encoded request headers, see codec.HeaderTemplate
+        self._header_templates = {}
 
     @op
     def get(self, key):
@@ -89,6 +144,34 @@ class Infinispan(object):
         resp = self._send(req)
         return self.val_serial.deserialize(resp.value)
 
+    @op
+    def get_many(self, keys):
+        """Sends requests to Infinispan server asking for values of many keys
+        at once. Keys are grouped by their owners (if known) and every owner
+        is asked in one request, requests to different owners are sent in
+        parallel.
+
+        :param keys: Keys associated with the values you want to retrieve.
+        :return: Dictionary of keys that exist and their values.
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        s_keys = self.key_serial.serialize_many(keys)
+        originals = dict(zip(s_keys, keys))
+
+        reqs = [(hotrod.GetAllRequest(
+                    n=len(group), keys=[hotrod.Key(key=k) for k in group]),
+                 owner)
+                for owner, group in self._group_by_owner(s_keys)]
+        entries = [entry for resp in self._send_many(reqs)
+                   for entry in resp.entries]
+
+        values = self.val_serial.deserialize_many(
+            [entry.value for entry in entries])
+        return {originals[entry.key]: value
+                for entry, value in zip(entries, values)}
+
     @op
     def get_with_version(self, key):
         """Sends a request to Infinispan server asking for a value with version
@@ -153,6 +236,42 @@ class Infinispan(object):
                           previous=previous)
         return self._return_is_ok_or_prev_val(resp, previous=previous)
 
+    @op
+    def put_many(self, entries, lifespan=None, max_idle=None,
+                 chunk_size=1000, chunk_bytes=1024 * 1024, concurrency=4):
+        """Stores many key-value pairs on the Infinispan server.
+
+        Entries are consumed lazily and sent in chunks, every chunk to the
+        owner of its keys (if known). Up to `concurrency` chunks are sent at
+        once, so only a few chunks are held in memory at any time.
+
+        :param entries: Dictionary or iterable of (key, value) pairs.
+        :param lifespan: How long should the key-value pairs be stored on the
+                         server. See :meth:`put` for details.
+        :param max_idle: How long can the key-value pairs be idle before they
+                         are removed from the server. See :meth:`put` for
+                         details.
+        :param chunk_size: Maximum number of entries sent in one request.
+        :param chunk_bytes: Approximate maximum size of serialized entries
+                            sent in one request.
+        :param concurrency: Maximum number of requests in flight at once.
+        :return: :obj:`True` if all entries were stored.
+        """
+        if hasattr(entries, 'items'):
+            entries = iteritems(entries)
+        chunks = self._chunk_entries(iter(entries), chunk_size, chunk_bytes)
+
+        with _Parallel(concurrency) as calls:
+            for owner, chunk in chunks:
+                if len(calls) >= concurrency:
+                    calls.wait()
+                req = hotrod.PutAllRequest(n=len(chunk), entries=chunk)
+                calls.submit(None, self._send, req, lifespan=lifespan,
+                             max_idle=max_idle, owner=owner)
+            while calls:
+                calls.wait()
+        return True
+
     @op
     def put_if_absent(self, key, value, lifespan=None, max_idle=None,
                       previous=False):
@@ -308,6 +427,46 @@ class Infinispan(object):
         resp = self._send(req)
         return {stat.name: stat.value for stat in resp.stats}
 
+    def iterate(self, batch_size=100, segments=None, with_metadata=False):
+        """Iterates over entries of the cache, entries are fetched lazily in
+        batches. Segments owned by different server nodes (if known) are
+        iterated in parallel, one batch per node is held in memory at most.
+
+        :param batch_size: Number of entries fetched from the server at once.
+        :param segments: Iterable of ids of segments to iterate over, all
+                         segments by default.
+        :param with_metadata: Iterate over metadata of the entries as well.
+        :return: Generator of (key, value) pairs or (key, value, metadata)
+                 tuples if metadata requested, see :meth:`get_with_metadata`
+                 for metadata format.
+        """
+        batches = [self._iterate_segments(owner, group, batch_size,
+                                          with_metadata)
+                   for owner, group in self._group_segments(segments)]
+        if len(batches) > 1:
+            batches = self._merge_batches(batches)
+        else:
+            batches = batches[0]
+
+        try:
+            for batch in batches:
+                keys = self.key_serial.deserialize_many(
+                    [entry.key for entry in batch])
+                values = self.val_serial.deserialize_many(
+                    [entry.value for entry in batch])
+                if not with_metadata:
+                    for kv in zip(keys, values):
+                        yield kv
+                    continue
+                for key, value, entry in zip(keys, values, batch):
+                    metadata = {attr: getattr(entry, attr) for attr in [
+                        "created", "lifespan", "last_used", "max_idle",
+                        "version"] if getattr(entry, attr)}
+                    yield key, value, metadata
+        finally:
+            # ends iterations on the server when abandoned early
+            batches.close()
+
     def connect(self):
         """Establishes connection with the server. If connection is already
         open, does not do anything."""
@@ -324,7 +483,8 @@ class Infinispan(object):
             if self.protocol.conn.connected:
                 self.protocol.conn.disconnect()
 
-    def _send(self, req, lifespan=None, max_idle=None, previous=False):
+    def _send(self, req, lifespan=None, max_idle=None, previous=False,
+              owner=None, conn=None):
         if not self.protocol.conn.connected:
             self.connect()
 
@@ -336,7 +496,7 @@ class Infinispan(object):
         req.header.cname = self.cache_name
         req.header.ci = self.ci
         req.header.t_id = self._curr_topology_id
-        resp = self.protocol.send(req)
+        resp = self._send_with_retry(req, owner, conn)
 
         log.debug("Received response of type %s", resp.__class__.__name__)
 
@@ -353,14 +513,186 @@ class Infinispan(object):
 
         return resp
 
+    def _send_with_retry(self, req, owner=None, conn=None):
+        deadline = time.time() + self.protocol.timeout
+        attempts = 1
+        while True:
+            try:
+                resp = self.protocol.send(
+                    req, template=self._get_header_template(req.header),
+                    conn=conn, owner=owner or self._get_owner(req),
+                    deadline=deadline)
+            except error.UnavailableError:
+                # the request never left, there is nothing to retry before
+                # the deadline (the pool waits for nodes out of selection)
+                raise
+            except error.ConnectionError as ex:
+                if type(req) not in _IDEMPOTENT or \
+                        not self.retry_policy.should_retry(attempts, deadline):
+                    raise
+                log.warning("Request of type %s failed (%s), retrying",
+                            req.__class__.__name__, ex)
+                attempts += 1
+            else:
+                self.retry_policy.succeeded()
+                return resp
+
+    def _send_many(self, reqs):
+        """Sends (request, owner) pairs in parallel, returns their
+        responses."""
+        if len(reqs) == 1:
+            return [self._send(reqs[0][0], owner=reqs[0][1])]
+
+        resps = [None] * len(reqs)
+        with _Parallel(len(reqs)) as calls:
+            for i, (req, owner) in enumerate(reqs):
+                calls.submit(i, self._send, req, owner=owner)
+            while calls:
+                for i, resp in calls.wait():
+                    resps[i] = resp
+        return resps
+
+    def _group_by_owner(self, s_keys):
+        """Returns list of (owner, serialized keys) pairs, owner is
+        :obj:`None` if unknown."""
+        ch = self._consistent_hash
+        if ch is None:
+            return [(None, s_keys)]
+        groups = {}
+        for key in s_keys:
+            groups.setdefault(ch.primary_owner(key), []).append(key)
+        return list(groups.items())
+
+    def _chunk_entries(self, entries, chunk_size, chunk_bytes):
+        """Serializes (key, value) pairs in batches and yields them in
+        chunks of :class:`hotrod.Entry`, as (owner, chunk) pairs."""
+        groups = {}
+        while True:
+            batch = list(islice(entries, chunk_size))
+            if not batch:
+                break
+            keys = self.key_serial.serialize_many([k for k, _ in batch])
+            values = self.val_serial.serialize_many([v for _, v in batch])
+
+            ch = self._consistent_hash
+            for key, value in zip(keys, values):
+                owner = ch.primary_owner(key) if ch is not None else None
+                group = groups.get(owner)
+                if group is None:
+                    group = groups[owner] = [[], 0]
+                group[0].append(hotrod.Entry(key=key, value=value))
+                group[1] += len(key) + len(value)
+                if len(group[0]) >= chunk_size or group[1] >= chunk_bytes:
+                    del groups[owner]
+                    yield owner, group[0]
+
+        for owner, group in groups.items():
+            yield owner, group[0]
+
+    def _group_segments(self, segments):
+        """Returns list of (owner, segments) pairs, owner is :obj:`None` if
+        unknown, segments are :obj:`None` for all segments."""
+        ch = self._consistent_hash
+        if ch is None:
+            return [(None, None if segments is None else list(segments))]
+        if segments is None:
+            segments = range(ch.segments_n)
+        groups = {}
+        for segment in segments:
+            groups.setdefault(ch.segment_owner(segment), []).append(segment)
+        return list(groups.items()) or [(None, [])]
+
+    def _iterate_segments(self, owner, segments, batch_size, with_metadata):
+        """Generates batches of :class:`hotrod.IterationEntry` of given
+        segments. Iteration lives on one server node, so all its requests
+        are sent over one connection."""
+        if not self.protocol.conn.connected:
+            self.connect()
+
+        with self.protocol.conn.context(owner) as conn:
+            req = hotrod.IterationStartRequest(
+                batch_size=batch_size, metadata=1 if with_metadata else 0)
+            if segments is not None:
+                req.segments = utils.to_bitset(segments)
+            iteration_id = self._send(req, conn=conn).iteration_id
+            try:
+                while True:
+                    resp = self._send(hotrod.IterationNextRequest(
+                        iteration_id=iteration_id), conn=conn)
+                    if not resp.entries:
+                        break
+                    yield resp.entries
+            finally:
+                self._end_iteration(iteration_id, conn)
+
+    def _end_iteration(self, iteration_id, conn):
+        try:
+            self._send(hotrod.IterationEndRequest(
+                iteration_id=iteration_id), conn=conn)
+        except (error.ConnectionError, error.ClientError) as ex:
+            # the server discards the iteration itself eventually
+            log.warning("Failed to end iteration %s (%s)", iteration_id, ex)
+
+    def _merge_batches(self, iterations):
+        """Fetches batches of many iterations in parallel, generates them as
+        they arrive."""
+        calls = _Parallel(len(iterations))
+        for it in iterations:
+            calls.submit(it, next, it, None)
+        try:
+            while calls:
+                for it, batch in calls.wait():
+                    if batch is not None:
+                        # next batch is fetched while this one is consumed
+                        calls.submit(it, next, it, None)
+                        yield batch
+        finally:
+            # iterations can be closed only when no thread runs them
+            calls.close()
+            for it in iterations:
+                it.close()
+
+    def _get_owner(self, req):
+        ch = self._consistent_hash
+        if ch is not None and 'key' in req.types:
+            return ch.primary_owner(req.key)
+
+    def _check_health(self, conn):
+        req = hotrod.PingRequest()
+        req.header.cname = self.cache_name
+        req.header.ci = self.ci
+        req.header.t_id = self._curr_topology_id
+        resp = self.protocol.send(req, conn=conn)
+        return resp.header.status == Status.OK
+
+    def _get_header_template(self, header):
+        key = (header.cname, header.flags, header.ci, header.version)
+        template = self._header_templates.get(key)
+        # template might be stale if created during topology change
+        if template is None or template.t_id != header.t_id:
+            template = codec.HeaderTemplate(header)
+            self._header_templates[key] = template
+        return template
+
     def _handle_topology_change(self, response):
         with self._lock:
             if response.header.tc.id != self._curr_topology_id:
                 self._curr_topology_id = response.header.tc.id
+                self._header_templates = {}
                 conns = [self.conn_type(host.ip, host.port,
-                                        timeout=self.protocol.timeout)
+                                        **self.conn_options)
                          for host in response.header.tc.hosts]
                 self.protocol.conn.update(conns)
+                self._consistent_hash = self._create_consistent_hash(
+                    response.header.tc)
+
+    def _create_consistent_hash(self, tc):
+        if getattr(tc, 'hf_version', None) != hotrod.HashFunction.MURMUR3:
+            return None
+        return hashing.ConsistentHash(
+            [(host.ip, host.port) for host in tc.hosts],
+            [[owner.index for owner in segment.owners]
+             for segment in tc.segments])
 
     def _set_ephemeral_props(self, req, lifespan=None, max_idle=None):
         if lifespan:
@@ -387,3 +719,38 @@ class Infinispan(object):
 
     def __exit__(self, type, value, traceback):
         self.disconnect()
+
+
+class _Parallel(object):
+    """Runs calls in threads of its own, at most `concurrency` of them at
+    once. Threads of the client's executor are not used, all of them might
+    be busy waiting in an async operation running the calls."""
+
+    def __init__(self, concurrency):
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._running = {}
+
+    def __len__(self):
+        return len(self._running)
+
+    def submit(self, tag, fn, *args, **kwargs):
+        """Starts a call, its result is returned by :meth:`wait` with the
+        given tag."""
+        self._running[self._executor.submit(fn, *args, **kwargs)] = tag
+
+    def wait(self):
+        """Waits until some of the calls finish, returns their (tag,
+        result) pairs. Raises the error of a failed call."""
+        done, _ = futures.wait(
+            self._running, return_when=futures.FIRST_COMPLETED)
+        return [(self._running.pop(f), f.result()) for f in done]
+
+    def close(self):
+        """Waits until all the calls finish."""
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
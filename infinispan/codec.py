@@ -1,53 +1,139 @@
 # -*- coding: utf-8 -*-
 
 import struct
-
-from builtins import bytes
+import threading
 
 import infinispan as ispn
 
 from infinispan import error
 
 
+_BYTE = struct.Struct('>B')
+_USHORT = struct.Struct('>H')
+_LONG = struct.Struct('>q')
+_ULONG = struct.Struct('>Q')
+
+
 class Encoder(object):
-    def __init__(self, byte_array=bytes()):
-        self._byte_array = byte_array
+    # encode plans compiled per message class, see :meth:`_compile`
+    _plans = {}
+
+    # buffers grown beyond this size are not kept around by :meth:`reset`
+    MAX_RETAINED_SIZE = 64 * 1024
+
+    # byte arrays at least this long are not copied by :meth:`encode_buffers`
+    SCATTER_THRESHOLD = 16 * 1024
+
+    def __init__(self, size_hint=256):
+        """Creates new encoder.
 
-    def encode(self, message):
+        :param size_hint: Initial size of the underlying buffer in bytes, the
+                          buffer grows as needed.
+        """
+        self.size_hint = size_hint
+        self._buffer = bytearray(size_hint)
+        self._pos = 0
+        # large byte arrays referenced instead of copied, by buffer position
+        self._refs = []
+        self._scatter = False
+
+    def encode(self, message, copy=True, template=None):
         """Encodes a message (request or a response).
 
         :param message: Message you want to encode.
+        :param copy: If :obj:`False`, a memoryview of the encoder's buffer is
+                     returned instead of a copy, see :meth:`view`.
+        :param template: Pre-encoded :class:`HeaderTemplate` to be used
+                         instead of encoding the request header.
         :return: Byte array which represents the encoded message.
         """
 
-        return self._encode(message).result()
+        self._encode_message(message, template)
+        return self.result() if copy else self.view()
 
-    def _encode(self, message):
-        for f_name in message.fields:
+    def encode_buffers(self, message, template=None):
+        """Encodes a message into a list of buffers that can be written with
+        a single scatter-gather send. Byte arrays longer than
+        `SCATTER_THRESHOLD` (e.g. values) are not copied, they are returned
+        as they are between views of the encoder's buffer.
+
+        :param message: Message you want to encode.
+        :param template: Pre-encoded :class:`HeaderTemplate` to be used
+                         instead of encoding the request header.
+        :return: List of buffers which represent the encoded message, valid
+                 only until the encoder is reset or written to again.
+        """
+
+        self._scatter = True
+        try:
+            self._encode_message(message, template)
+        finally:
+            self._scatter = False
+        return self.buffers()
+
+    def _encode_message(self, message, template):
+        if template is None:
+            self._encode(message)
+        else:
+            template.write(self, message.header)
+            self._encode(message, skip_fields=1)
+
+    def _encode(self, message, skip_fields=0):
+        try:
+            plan = self._plans[message.__class__]
+        except KeyError:
+            plan = self._compile(message)
+
+        if skip_fields:
+            plan = plan[skip_fields:]
+        for f_name, condition, optional, write, args in plan:
             f = getattr(message, f_name)
-            f_cls = getattr(message.__class__, f_name)
 
             # test if field is available only under condition
-            if hasattr(f_cls, 'condition') and not f_cls.condition(message):
+            if condition is not None and not condition(message):
                 continue
             # test if field is none and raise an error if so (unless optional)
-            if f is None and \
-                    not (hasattr(f_cls, 'optional') and f_cls.optional):
+            if f is None and not optional:
                 raise error.EncodeError(
                     "Field '%s' of '%s#%s' must not be None",
                     f, type(message).__name__, f_name)
 
+            write(self, f, *args)
+        return self
+
+    def _encode_list(self, l):
+        for elem in l:
+            self._encode(elem)
+        return self
+
+    @classmethod
+    def _compile(cls, message):
+        """Compiles a flat encode plan for the class of the message, so that
+        the field metadata doesn't have to be looked up on every encode.
+        """
+
+        plan = []
+        for f_name in message.fields:
+            f_cls = message.types[f_name]
             if f_cls.type == "composite":
-                self._encode(f)
+                write = cls._encode
             elif f_cls.type == "list":
-                for elem in f:
-                    self._encode(elem)
+                write = cls._encode_list
             else:
-                getattr(self, f_cls.type)(f, *f_cls.args)
-        return self
+                write = getattr(cls, f_cls.type)
+            plan.append((f_name, getattr(f_cls, 'condition', None),
+                         getattr(f_cls, 'optional', False), write,
+                         tuple(f_cls.args)))
+        plan = tuple(plan)
+        cls._plans[message.__class__] = plan
+        return plan
 
     def byte(self, b):
-        self._append(struct.pack('>B', b))
+        pos = self._pos
+        if pos >= len(self._buffer):
+            self._reserve(1)
+        self._buffer[pos] = b
+        self._pos = pos + 1
         return self
 
     def bytes(self, byte_array, size):
@@ -57,7 +143,18 @@ class Encoder(object):
     def varbytes(self, byte_array):
         n = len(byte_array)
         self.uvarint(n)
-        self.bytes(byte_array, n)
+        if self._scatter and n >= self.SCATTER_THRESHOLD:
+            self._refs.append((self._pos, byte_array))
+        else:
+            self.bytes(byte_array, n)
+        return self
+
+    def nullablevarbytes(self, byte_array):
+        if byte_array is None:
+            self.varint(-1)
+        else:
+            self.varint(len(byte_array))
+            self.bytes(byte_array, len(byte_array))
         return self
 
     def splitbyte(self, b2):
@@ -65,21 +162,21 @@ class Encoder(object):
         return self
 
     def ushort(self, ushort):
-        self._append(struct.pack('>H', ushort))
+        self._reserve(2)
+        _USHORT.pack_into(self._buffer, self._pos, ushort)
+        self._pos += 2
         return self
 
     def uvarint(self, uvarint):
-        encoded_uvar = self._uvar(uvarint)
-        if len(encoded_uvar) > 5:
-            raise error.EncodeError("Value too high")
-        self._append(encoded_uvar)
+        self._uvar(uvarint, maxlen=5)
         return self
 
     def uvarlong(self, uvarlong):
-        encoded_uvar = self._uvar(uvarlong)
-        if len(encoded_uvar) > 9:
-            raise error.EncodeError("Value too high")
-        self._append(encoded_uvar)
+        self._uvar(uvarlong, maxlen=9)
+        return self
+
+    def varint(self, varint):
+        self._uvar(((varint << 1) ^ (varint >> 31)) & 0xffffffff, maxlen=5)
         return self
 
     def string(self, string):
@@ -90,94 +187,233 @@ class Encoder(object):
         return self
 
     def long(self, l):
-        self._append(struct.pack('>q', l))
+        self._reserve(8)
+        _LONG.pack_into(self._buffer, self._pos, l)
+        self._pos += 8
         return self
 
     def result(self):
-        return self._byte_array
-
-    def _uvar(self, uvar):
-        result = bytes()
-        bits = uvar & 0x7f
-        uvar >>= 7
-        while uvar:
-            result += struct.pack('>B', 0x80 | bits)
-            bits = uvar & 0x7f
+        """Returns a copy of the encoded data."""
+        return self.view().tobytes()
+
+    def view(self):
+        """Returns encoded data without copying them. The view is valid only
+        until the encoder is reset or written to again.
+        """
+        return memoryview(self._buffer)[:self._pos]
+
+    def buffers(self):
+        """Returns encoded data as a list of buffers, views of the encoder's
+        buffer interleaved with byte arrays referenced by
+        :meth:`encode_buffers`. Valid only until the encoder is reset or
+        written to again.
+        """
+        view = memoryview(self._buffer)
+        buffers = []
+        start = 0
+        for pos, byte_array in self._refs:
+            if pos > start:
+                buffers.append(view[start:pos])
+            buffers.append(byte_array)
+            start = pos
+        if self._pos > start or not buffers:
+            buffers.append(view[start:self._pos])
+        return buffers
+
+    def reset(self):
+        """Discards encoded data so that the encoder can be reused."""
+        if len(self._buffer) > self.MAX_RETAINED_SIZE:
+            self._buffer = bytearray(self.size_hint)
+        self._pos = 0
+        if self._refs:
+            del self._refs[:]
+        return self
+
+    def _uvar(self, uvar, maxlen):
+        size = _uvar_size(uvar)
+        if size > maxlen:
+            raise error.EncodeError("Value too high")
+        self._reserve(size)
+        buf, pos = self._buffer, self._pos
+        for _ in range(size - 1):
+            buf[pos] = 0x80 | (uvar & 0x7f)
             uvar >>= 7
-        result += struct.pack('>B', bits)
-        return result
+            pos += 1
+        buf[pos] = uvar
+        self._pos = pos + 1
 
     def _append(self, byte_array):
-        self._byte_array += byte_array
+        pos, n = self._pos, len(byte_array)
+        if pos + n <= len(self._buffer):
+            self._buffer[pos:pos + n] = byte_array
+        else:
+            # append to the end directly instead of zero-filling first
+            del self._buffer[pos:]
+            self._buffer += byte_array
+        self._pos = pos + n
+
+    def _reserve(self, n):
+        missing = self._pos + n - len(self._buffer)
+        if missing > 0:
+            # at least double the buffer to keep appends amortized linear
+            self._buffer += b'\x00' * max(missing, len(self._buffer))
+
+
+def _uvar_size(uvar):
+    return max(1, (uvar.bit_length() + 6) // 7)
+
+
+class HeaderTemplate(object):
+    """Request header encoded in advance, except for the message id and the
+    operation code that change with every request.
+    """
+
+    def __init__(self, header):
+        """Creates new template.
+
+        :param header: :class:`hotrod.RequestHeader` the template is made of.
+        """
+
+        self.magic = header.magic
+        self.version = header.version
+        self.t_id = header.t_id
+        self.tail = Encoder().string(header.cname).uvarint(header.flags) \
+            .byte(header.ci).uvarint(header.t_id).result()
+
+    def write(self, encoder, header):
+        """Writes the header into the encoder.
+
+        :param encoder: :class:`Encoder` to write the header into.
+        :param header: Request header with message id and operation code.
+        """
+
+        encoder.byte(self.magic).uvarlong(header.id).byte(self.version) \
+            .byte(header.op)._append(self.tail)
 
 
 class Decoder(object):
-    _OPS = None
+    """Decodes responses from a contiguous buffer, reading at an offset.
+
+    The data are either a bytes-like object holding whole message, or a
+    generator of byte arrays (see :meth:`SocketConnection.recv`) that the
+    decoder asks for exactly as many bytes as it is missing.
+    """
 
-    def __init__(self, byte_gen=None):
-        self._byte_gen = byte_gen
+    # decode plans compiled per message class, see :meth:`_compile`
+    _plans = {}
 
-    def decode(self, data):
+    def __init__(self, data=None, header_type=None):
+        """Creates new decoder.
+
+        :param data: Data to decode from, see :meth:`decode`.
+        :param header_type: Class of response headers,
+                            :class:`hotrod.ResponseHeader` by default. Must
+                            match client intelligence of the requests.
+        """
+        self._header_type = header_type
+        self._buffer = b''
+        self._pos = 0
+        self._byte_gen = None
+        self._started = False
+        if data is not None:
+            self._set_data(data)
+
+    def decode(self, data, offset=0):
         """Decodes a response from a byte array.
 
-        :param data: Byte array that represents the response.
+        :param data: Byte array that represents the response, or a generator
+                     of byte arrays.
+        :param offset: Position in the byte array where the response starts.
         :return: Response object.
         """
 
-        rh = ispn.hotrod.ResponseHeader()
-        self._byte_gen = data
+        rh = (self._header_type or ispn.hotrod.ResponseHeader)()
+        self._set_data(data, offset)
         self._decode(rh)
 
-        # if ops map not yet initialized, init it (can't be done statically)
-        if not self._OPS:
-            self._OPS = {r.OP_CODE: r for r in ispn.utils.get_all_subclasses(
-                         ispn.hotrod.Response) if hasattr(r, 'OP_CODE')}
-        try:
-            response = self._OPS[rh.op](header=rh)
-        except KeyError:
+        response_cls = ispn.hotrod.RESPONSE_TYPES[rh.op]
+        if response_cls is None:
             raise error.DecodeError(
                 "Response operation with code %s is not supported.", rh.op)
+        response = response_cls(header=rh)
         self._decode(response, skip_fields=1)
 
         return response
 
     def _decode(self, message, skip_fields=0):
-        for f_name in message.fields[skip_fields:]:
-            f = getattr(message, f_name)
-            f_cls = getattr(message.__class__, f_name)
+        try:
+            plan = self._plans[message.__class__]
+        except KeyError:
+            plan = self._compile(message)
 
-            if 'condition' in dir(f_cls) and not f_cls.condition(message):
+        for f_name, condition, read, args, size in plan[skip_fields:]:
+            if condition is not None and not condition(message):
                 continue
+            if size is not None:
+                args = (args[0], size(message))
+            setattr(message, f_name, read(self, *args))
+        return message
+
+    def _decode_composite(self, of):
+        return self._decode(of())
+
+    def _decode_list(self, of, size):
+        return [self._decode(of()) for _ in range(size)]
+
+    @classmethod
+    def _compile(cls, message):
+        """Compiles a flat decode plan for the class of the message, see
+        :meth:`Encoder._compile`.
+        """
 
+        plan = []
+        for f_name in message.fields:
+            f_cls = message.types[f_name]
+            size = None
             if f_cls.type == "composite":
-                self._decode(f)
+                read, args = cls._decode_composite, (f_cls.default,)
             elif f_cls.type == "list":
-                l = []
-                for _ in range(f_cls.size(message)):
-                    elem = f_cls.of()
-                    l.append(elem)
-                    self._decode(elem)
-                setattr(message, f_name, l)
+                read, args = cls._decode_list, (f_cls.of,)
+                size = f_cls.size
             else:
-                decoded = getattr(self, f_cls.type)(*f_cls.args)
-                setattr(message, f_name, decoded)
+                read, args = getattr(cls, f_cls.type), tuple(f_cls.args)
+            plan.append((f_name, getattr(f_cls, 'condition', None), read,
+                         args, size))
+        plan = tuple(plan)
+        cls._plans[message.__class__] = plan
+        return plan
 
     def byte(self):
-        b = ord(self._read_next())
-        return b
+        pos = self._pos
+        if pos + 1 > len(self._buffer):
+            self._fill(1)
+            pos = self._pos
+        self._pos = pos + 1
+        return _BYTE.unpack_from(self._buffer, pos)[0]
 
     def bytes(self, size):
-        byte_array = bytes()
-        for i in range(size):
-            byte_array += bytes([self.byte()])
-        return byte_array
+        pos = self._pos
+        if pos + size > len(self._buffer):
+            self._fill(size)
+            pos = self._pos
+        self._pos = pos + size
+        return memoryview(self._buffer)[pos:pos + size].tobytes()
 
     def varbytes(self):
         n = self.uvarint()
         return self.bytes(n)
 
     def ushort(self):
-        return (self.byte() << 8) + self.byte()
+        pos = self._pos
+        if pos + 2 > len(self._buffer):
+            self._fill(2)
+            pos = self._pos
+        self._pos = pos + 2
+        return _USHORT.unpack_from(self._buffer, pos)[0]
+
+    def nullablevarbytes(self):
+        n = self.varint()
+        return self.bytes(n) if n >= 0 else None
 
     def splitbyte(self):
         b = self.byte()
@@ -190,14 +426,20 @@ class Decoder(object):
     def uvarlong(self):
         return self._uvar(maxlen=9)
 
+    def varint(self):
+        uvar = self._uvar(maxlen=5)
+        return (uvar >> 1) ^ -(uvar & 1)
+
     def string(self):
         return self.varbytes().decode('UTF-8')
 
     def long(self):
-        return (self.byte() << 56) + (self.byte() << 48) + \
-               (self.byte() << 40) + (self.byte() << 32) + \
-               (self.byte() << 24) + (self.byte() << 16) + \
-               (self.byte() << 8) + self.byte()
+        pos = self._pos
+        if pos + 8 > len(self._buffer):
+            self._fill(8)
+            pos = self._pos
+        self._pos = pos + 8
+        return _ULONG.unpack_from(self._buffer, pos)[0]
 
     def _uvar(self, maxlen=5):
         b = self.byte()
@@ -211,22 +453,121 @@ class Decoder(object):
             i += 1
         return uvar
 
-    def _read_next(self):
+    @property
+    def offset(self):
+        """Position right after the last decoded byte."""
+        return self._pos
+
+    def _set_data(self, data, offset=0):
+        if hasattr(data, 'send'):
+            self._buffer, self._byte_gen = b'', data
+        else:
+            self._buffer, self._byte_gen = data, None
+        self._pos = offset
+        self._started = False
+
+    def _fill(self, n):
+        """Makes sure there are at least n bytes available at the current
+        offset by reading the missing bytes from the byte generator.
+        """
+
+        if self._byte_gen is None:
+            raise error.IncompleteError(
+                "Unexpected end of byte array", self._pos + n)
+
+        buf = bytearray(memoryview(self._buffer)[self._pos:])
+        while len(buf) < n:
+            buf += self._read_next(n - len(buf))
+        self._buffer, self._pos = buf, 0
+
+    def _read_next(self, n):
         try:
-            byte = next(self._byte_gen)
+            if self._started:
+                packet = self._byte_gen.send(n)
+            else:
+                # a just started generator can't be sent a value
+                packet = next(self._byte_gen)
+                self._started = True
         except StopIteration:
             raise error.DecodeError(
                 "Unexpected end of byte array generator")
-        if not byte:
+        if not packet:
             raise error.DecodeError("Value is empty")
-        return byte
+        return packet
+
+
+class ResponseParser(object):
+    """Incremental parser of a stream of responses that does no I/O itself.
+
+    Feed it with data as they arrive (from a blocking socket, a selector loop
+    or a recorded stream) and it returns responses once they are complete.
+    Bytes of partially received responses are kept until the next feed.
+    """
+
+    def __init__(self, header_type=None):
+        self._buffer = bytearray()
+        self._needed = 1
+        self._decoder = Decoder(header_type=header_type)
+
+    def feed(self, data):
+        """Adds received data to the parser.
+
+        :param data: Bytes-like object with the received data.
+        :return: List of responses completed by the data, can be empty.
+        """
+
+        buf = self._buffer
+        buf += data
+        responses = []
+        pos = 0
+        # don't try to decode again until the missing bytes arrive
+        while len(buf) - pos >= self._needed:
+            try:
+                response = self._decoder.decode(buf, pos)
+            except error.IncompleteError as ex:
+                self._needed = ex.needed - pos
+                break
+            pos = self._decoder.offset
+            self._needed = 1
+            responses.append(response)
+
+        if pos:
+            del buf[:pos]
+        return responses
+
+    @property
+    def needed(self):
+        """Minimum number of bytes required to complete the next response."""
+        return max(self._needed - len(self._buffer), 1)
+
+    @property
+    def buffered(self):
+        """Number of bytes of a partially received response."""
+        return len(self._buffer)
+
+    def reset(self):
+        """Discards the partially received response."""
+        self._buffer = bytearray()
+        self._needed = 1
 
 
 class EncoderFactory(object):
+    """Hands out one reusable encoder per thread."""
+
+    def __init__(self, size_hint=256):
+        self.size_hint = size_hint
+        self._local = threading.local()
+
     def get(self):
-        return Encoder()
+        encoder = getattr(self._local, 'encoder', None)
+        if encoder is None:
+            encoder = self._local.encoder = Encoder(self.size_hint)
+        return encoder.reset()
 
 
 class DecoderFactory(object):
+    def __init__(self, header_type=None):
+        self.header_type = header_type
+
     def get(self):
-        return Decoder()
+        return Decoder(header_type=self.header_type)
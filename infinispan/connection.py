@@ -1,42 +1,196 @@
 # -*- coding: utf-8 -*-
 
 import time
+import random
 import socket
 import threading
 
 from infinispan import error
 from contextlib import contextmanager
 
+# maximum number of buffers written by one sendmsg call
+_IOV_MAX = 1024
+
+# weight of the newest request duration in the latency moving average
+_LATENCY_WEIGHT = 0.2
+
 
 class SocketConnection(object):
-    def __init__(self, host="127.0.0.1", port=11222, timeout=10):
+    def __init__(self, host="127.0.0.1", port=11222, timeout=10,
+                 buffer_size=64 * 1024, connect_timeout=None, nodelay=True,
+                 keepalive=False, keepalive_idle=None, keepalive_interval=None,
+                 keepalive_count=None, rcvbuf=None, sndbuf=None,
+                 coalesce_delay=None, coalesce_bytes=64 * 1024,
+                 coalesce_count=64):
+        """Creates new socket connection.
+
+        :param timeout: How long to block on reads and writes, in seconds.
+        :param buffer_size: Size of the receive buffer.
+        :param connect_timeout: How long to wait for the connection to be
+                                established, same as timeout by default.
+        :param nodelay: Disables Nagle's algorithm (TCP_NODELAY) so that small
+                        requests are sent immediately.
+        :param keepalive: Enables TCP keepalive (SO_KEEPALIVE) so that dead
+                          peers are detected on idle connections.
+        :param keepalive_idle: Idle time before the first keepalive probe is
+                               sent, in seconds.
+        :param keepalive_interval: Time between keepalive probes, in seconds.
+        :param keepalive_count: Number of unanswered keepalive probes before
+                                the connection is dropped.
+        :param rcvbuf: Size of the kernel receive buffer (SO_RCVBUF).
+        :param sndbuf: Size of the kernel send buffer (SO_SNDBUF).
+        :param coalesce_delay: Enables write coalescing, data sent by
+                               concurrent threads are queued and written
+                               together at most this many seconds later
+                               (e.g. 0.0001 for 100 microseconds).
+        :param coalesce_bytes: Queued data are written immediately once there
+                               is this many bytes of them.
+        :param coalesce_count: Queued data are written immediately once this
+                               many sends are queued.
+        """
         self.host = host
         self.port = port
         self.timeout = timeout
+        self.buffer_size = buffer_size
+        self.connect_timeout = connect_timeout
+        self.nodelay = nodelay
+        self.keepalive = keepalive
+        self.keepalive_idle = keepalive_idle
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.coalesce_delay = coalesce_delay
+        self.coalesce_bytes = coalesce_bytes
+        self.coalesce_count = coalesce_count
         self._s = None
+        # set when the connection fails and cannot be used any more
+        self.broken = False
+        # moving average of request durations in seconds, see :meth:`observe`
+        self.latency = None
         self.lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        # batch of data queued for coalesced write
+        self._batch = None
+        self._batch_cond = threading.Condition(threading.Lock())
+        # receive buffer and the range of bytes not yet handed out
+        self._buffer = bytearray(buffer_size)
+        self._start = self._end = 0
 
     def connect(self):
         if self._s:
             raise error.ConnectionError("Already connected.")
+        self.broken = False
         self._s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
+            self._set_options(self._s)
+            self._s.settimeout(
+                self.connect_timeout if self.connect_timeout is not None
+                else self.timeout)
             self._s.connect((self.host, self.port))
-            self._s.setblocking(0)
+            # block on reads and writes, but not longer than the timeout
+            self._s.settimeout(self.timeout)
+        except socket.timeout:
+            self._s.close()
+            self._s = None
+            raise error.ConnectionError("Connection timeout.")
         except socket.error:
+            self._s.close()
             self._s = None
             raise error.ConnectionError("Connection refused.")
 
-    def send(self, byte_array):
+    def send(self, data):
+        """Sends all data, either a byte array or a list of byte arrays which
+        are sent as a single write where the platform supports it.
+        """
         if not self._s:
             raise error.ConnectionError("Not connected.")
 
+        buffers = data if isinstance(data, (list, tuple)) else (data,)
+        if self.coalesce_delay is not None:
+            self._send_coalesced(buffers)
+            return
         try:
-            ret = self._s.send(byte_array)
+            # requests sent by concurrent threads must not interleave
+            with self._send_lock:
+                self._write(buffers)
         except socket.error:
+            self.broken = True
             raise error.ConnectionError("Socket connection broken.")
-        if ret == 0:
-            raise error.ConnectionError("Socket connection broken.")
+
+    def _send_coalesced(self, buffers):
+        """Queues buffers into the current batch and waits until the batch is
+        written. The thread that opened the batch writes it once it is full
+        or the coalesce delay passes."""
+
+        with self._batch_cond:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            batch.add(buffers)
+            if batch.full(self.coalesce_bytes, self.coalesce_count):
+                self._batch_cond.notify_all()
+
+            if not leader:
+                while not batch.done:
+                    self._batch_cond.wait()
+                if batch.error:
+                    raise batch.error
+                return
+
+            deadline = time.time() + self.coalesce_delay
+            while not batch.full(self.coalesce_bytes, self.coalesce_count):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._batch_cond.wait(remaining)
+            # close the batch, further data are queued into a new one
+            self._batch = None
+
+        try:
+            with self._send_lock:
+                self._write(batch.buffers)
+        except socket.error:
+            self.broken = True
+            batch.error = error.ConnectionError("Socket connection broken.")
+        finally:
+            with self._batch_cond:
+                batch.done = True
+                self._batch_cond.notify_all()
+        if batch.error:
+            raise batch.error
+
+    def _write(self, buffers):
+        if len(buffers) == 1:
+            self._s.sendall(buffers[0])
+        elif hasattr(self._s, "sendmsg"):
+            self._sendmsg(buffers)
+        else:
+            # no scatter-gather sends (Python 2), buffers are joined so that
+            # they are still written at once
+            data = bytearray()
+            for byte_array in buffers:
+                data += byte_array
+            self._s.sendall(data)
+
+    def _sendmsg(self, buffers):
+        """Writes buffers with scatter-gather sends until all are written,
+        a send may write only part of them."""
+
+        buffers = [_byte_view(b) for b in buffers if len(b)]
+        i = 0
+        while i < len(buffers):
+            sent = self._s.sendmsg(buffers[i:i + _IOV_MAX])
+            # skip buffers written completely, cut the written part off the
+            # one written partially
+            while sent:
+                n = len(buffers[i])
+                if sent < n:
+                    buffers[i] = buffers[i][sent:]
+                    break
+                sent -= n
+                i += 1
 
     def recv(self):
         if not self._s:
@@ -44,15 +198,7 @@ class SocketConnection(object):
 
         n = 1
         while n != 0:
-            try:
-                packet = self._read_packet(n)
-            except socket.error:
-                raise error.ConnectionError(
-                    "Connection reset by peer.")
-            if not packet:
-                raise error.ConnectionError(
-                    "The remote end hung up unexpectedly.")
-            n = yield packet
+            n = yield self._read_packet(n)
             # must test for None as 0 is termination
             n = n if n is not None else 1
 
@@ -66,35 +212,87 @@ class SocketConnection(object):
             pass
         self._s.close()
         self._s = None
+        self._start = self._end = 0
 
     @property
     def connected(self):
         return self._s is not None
 
+    def observe(self, seconds):
+        """Records how long a request sent through the connection took, the
+        durations are kept as an exponentially weighted moving average."""
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += _LATENCY_WEIGHT * (seconds - self.latency)
+
+    def copy(self):
+        """Returns new unconnected socket connection to the same node with
+        the same configuration, of the same type."""
+        return type(self)(
+            self.host, self.port, timeout=self.timeout,
+            buffer_size=self.buffer_size, connect_timeout=self.connect_timeout,
+            nodelay=self.nodelay, keepalive=self.keepalive,
+            keepalive_idle=self.keepalive_idle,
+            keepalive_interval=self.keepalive_interval,
+            keepalive_count=self.keepalive_count, rcvbuf=self.rcvbuf,
+            sndbuf=self.sndbuf, coalesce_delay=self.coalesce_delay,
+            coalesce_bytes=self.coalesce_bytes,
+            coalesce_count=self.coalesce_count)
+
     @contextmanager
-    def context(self):
+    def context(self, owner=None, deadline=None):
         yield self
 
+    def _set_options(self, s):
+        # buffer sizes must be set before connecting to affect TCP window
+        if self.rcvbuf is not None:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if self.sndbuf is not None:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.nodelay:
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.keepalive:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # fine-tuning of keepalive is not available on all platforms
+            for name, value in (("TCP_KEEPIDLE", self.keepalive_idle),
+                                ("TCP_KEEPINTVL", self.keepalive_interval),
+                                ("TCP_KEEPCNT", self.keepalive_count)):
+                if value is not None and hasattr(socket, name):
+                    s.setsockopt(
+                        socket.IPPROTO_TCP, getattr(socket, name), value)
+
     def _read_packet(self, n):
-        packet = None
-        delay = 50.0 / 1000.0
-        mustend = time.time() + self.timeout
-        try_again = True
-        while try_again:
-            try_again = False
-            try:
-                packet = self._s.recv(n)
-            except socket.error as ex:
-                if ex.errno != 11:
-                    raise ex
-                try_again = True
-
-                if time.time() > mustend:
-                    raise error.ConnectionError("Connection timeout.")
-                time.sleep(delay)
-                if delay < 0.4:
-                    delay *= 2
-        return packet
+        """Returns at most n received bytes. Bytes are served from the receive
+        buffer, which is refilled only once it is drained.
+        """
+
+        if self._start == self._end:
+            if n >= self.buffer_size:
+                # large reads don't fit in the buffer, don't copy them twice
+                return self._recv(self._s.recv, n)
+            self._start, self._end = 0, self._recv(
+                self._s.recv_into, self._buffer)
+
+        start = self._start
+        self._start = min(start + n, self._end)
+        return memoryview(self._buffer)[start:self._start]
+
+    def _recv(self, recv, arg):
+        # the stream cannot be read any further after any failure
+        try:
+            ret = recv(arg)
+        except socket.timeout:
+            self.broken = True
+            raise error.ConnectionError("Connection timeout.")
+        except socket.error:
+            self.broken = True
+            raise error.ConnectionError("Connection reset by peer.")
+        if not ret:
+            self.broken = True
+            raise error.ConnectionError(
+                "The remote end hung up unexpectedly.")
+        return ret
 
     def __hash__(self):
         return hash((self.host, self.port))
@@ -109,51 +307,599 @@ class SocketConnection(object):
         return "%s:%s" % (self.host, self.port)
 
 
+def _byte_view(byte_array):
+    view = memoryview(byte_array)
+    return view if view.format == 'B' else view.cast('B')
+
+
+class _Batch(object):
+    """Data of concurrent sends written together."""
+
+    __slots__ = ('buffers', 'size', 'count', 'done', 'error')
+
+    def __init__(self):
+        self.buffers = []
+        self.size = 0
+        self.count = 0
+        self.done = False
+        self.error = None
+
+    def add(self, buffers):
+        self.buffers.extend(buffers)
+        self.size += sum(map(len, buffers))
+        self.count += 1
+
+    def full(self, size, count):
+        return self.size >= size or self.count >= count
+
+
 class ConnectionPool(object):
-    def __init__(self, connections=None):
-        self._connections = connections if (connections is not None) else []
-        self._lock = threading.Lock()
-        self._curr = 0
+    """Pool of sockets to one or more server nodes.
+
+    Sockets of a node are opened lazily up to `max_size` when all of them are
+    busy. A socket is busy once `max_pending` requests use it at once,
+    `max_pending=1` means that a socket is checked out exclusively. Sockets
+    above `min_size` that were not used for `idle_timeout` seconds are
+    closed.
+
+    A broken socket is closed when checked in, together with idle sockets of
+    the same node, and the node is taken out of selection for a jittered
+    exponentially growing time. Sockets idle for `health_check_interval`
+    seconds are checked with `health_check` before they are checked out.
+    """
+
+    def __init__(self, connections=None, min_size=1, max_size=1,
+                 max_pending=None, wait_timeout=10, idle_timeout=60,
+                 health_check=None, health_check_interval=30,
+                 backoff_base=0.1, backoff_max=10, strategy=None):
+        """Creates new connection pool.
+
+        :param connections: Connections to server nodes, one per node.
+        :param min_size: Number of sockets per node opened on connect and
+                         never closed for being idle.
+        :param max_size: Maximum number of sockets per node.
+        :param max_pending: Maximum number of requests sharing a socket at
+                            once, unlimited by default.
+        :param wait_timeout: How long to wait for a socket when all of them
+                             are busy, in seconds.
+        :param idle_timeout: How long can a socket above min_size stay unused
+                             before it is closed, in seconds.
+        :param health_check: Function called with an idle connection before
+                             it is checked out, returns :obj:`False` or
+                             raises :class:`error.ConnectionError` if the
+                             connection cannot be used.
+        :param health_check_interval: How long can a socket stay unused
+                                      before it is checked, in seconds.
+        :param backoff_base: How long is a failed node out of selection after
+                             the first failure, in seconds. The time doubles
+                             with every following failure.
+        :param backoff_max: Maximum time a failed node is out of selection,
+                            in seconds.
+        :param strategy: Node selection strategy, :class:`RoundRobin` by
+                         default.
+        """
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size, 1)
+        self.max_pending = max_pending
+        self.wait_timeout = wait_timeout
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self.health_check_interval = health_check_interval
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.strategy = strategy if strategy is not None else RoundRobin()
+        self._nodes = [_Node(conn) for conn in (connections or [])]
+        # removed nodes with sockets still in use
+        self._draining = []
+        self._cond = threading.Condition(threading.Lock())
+        self._connected = False
 
     def connect(self):
-        for conn in self._connections:
-            if not conn.connected:
-                conn.connect()
+        """Opens min_size sockets to every node. Fails only if no node can
+        be connected to, the other nodes are retried later."""
+
+        with self._cond:
+            failure = None
+            for node in self._nodes:
+                try:
+                    node.fill(self.min_size)
+                except error.ConnectionError as ex:
+                    self._fail(node)
+                    failure = ex
+            if failure and not any(node.sockets for node in self._nodes):
+                raise failure
+            self._connected = True
 
     def disconnect(self):
-        for conn in self._connections:
-            if conn.connect:
-                conn.disconnect()
+        with self._cond:
+            for node in self._nodes + self._draining:
+                node.close()
+            self._draining = []
+            self._connected = False
+            self._cond.notify_all()
 
     def update(self, connections):
-        conns_to_remove = list(self._connections)
-        for conn in connections:
-            if conn not in self._connections:
-                self._connections.append(conn)
-            else:
-                conns_to_remove.remove(conn)
-        for conn_to_remove in conns_to_remove:
-            self._connections.remove(conn_to_remove)
-            if conn_to_remove.connected:
-                conn_to_remove.disconnect()
+        """Replaces nodes of the pool with nodes of given connections without
+        disrupting requests in flight.
+
+        New nodes are connected to in background and selected only once
+        they are connected (or if there are no other nodes). Removed nodes
+        are no longer selected, their sockets are closed as soon as requests
+        using them complete.
+
+        :param connections: Connections to server nodes, one per node.
+        :return: Thread connecting to new nodes or :obj:`None` if there are
+                 no new nodes.
+        """
+
+        with self._cond:
+            nodes = []
+            new_nodes = []
+            for conn in connections:
+                node = next((n for n in self._nodes if n.conn == conn), None)
+                if node is None:
+                    node = _Node(conn)
+                    node.warming = self._connected
+                    new_nodes.append(node)
+                nodes.append(node)
+            for node_to_remove in self._nodes:
+                if node_to_remove not in nodes:
+                    node_to_remove.drain()
+                    if node_to_remove.sockets:
+                        self._draining.append(node_to_remove)
+            # requests pick nodes from the new table from now on
+            self._nodes = nodes
+            self._cond.notify_all()
+
+        warming = [node for node in new_nodes if node.warming]
+        if not warming:
+            return None
+        thread = threading.Thread(target=self._warm_up, args=(warming,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _warm_up(self, nodes):
+        for node in nodes:
+            conns = []
+            try:
+                for _ in range(self.min_size):
+                    conn = node.take()
+                    conn.connect()
+                    conns.append(conn)
+            except error.ConnectionError:
+                with self._cond:
+                    self._fail(node)
+            with self._cond:
+                if node in self._nodes:
+                    node.sockets.extend(_Socket(conn) for conn in conns)
+                else:
+                    # removed while connecting
+                    for conn in conns:
+                        conn.disconnect()
+                node.warming = False
+                self._cond.notify_all()
 
     @property
     def connected(self):
-        return all(map(lambda c: c.connected, self._connections))
+        return self._connected
 
     @property
     def size(self):
-        return len(self._connections)
+        return len(self._nodes)
 
     @contextmanager
-    def context(self):
-        conn = self._get_next()
-        yield conn
+    def context(self, owner=None, deadline=None):
+        conn = self.checkout(owner, deadline)
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    def checkout(self, owner=None, deadline=None):
+        """Returns a socket that can be used for sending requests, waits if
+        all sockets are busy or all nodes are out of selection after a
+        failure. Every socket checked out must be returned by
+        :meth:`checkin`.
+
+        :param owner: Address (host, port) of the node that is tried first,
+                      other nodes are used only if it is not available.
+        :param deadline: Time until which to wait at most, `wait_timeout`
+                         from now if sooner or not given.
+        """
+
+        wait_deadline = time.time() + self.wait_timeout
+        deadline = min(deadline or wait_deadline, wait_deadline)
+        while True:
+            conn, idle = self._acquire(deadline, owner)
+            if not idle or self._healthy(conn):
+                return conn
+            # the stale socket is replaced, node is not taken out of
+            # selection unless connecting to it fails too
+            self._discard(conn)
+
+    def checkin(self, conn):
+        """Returns a socket obtained from :meth:`checkout` to the pool."""
+
+        with self._cond:
+            now = time.time()
+            for node in self._draining:
+                sock = node.find(conn)
+                if sock:
+                    sock.pending -= 1
+                    if sock.pending == 0:
+                        node.remove(sock)
+                        if not node.sockets:
+                            self._draining.remove(node)
+                    return
+            for node in self._nodes:
+                sock = node.find(conn)
+                if sock:
+                    sock.pending -= 1
+                    sock.used = now
+                    if conn.broken:
+                        # broken socket usually means the node restarted, so
+                        # idle sockets of the node are likely broken too
+                        node.evict(sock)
+                        self._fail(node)
+                        self._cond.notify_all()
+                    else:
+                        node.reap(self.min_size, now - self.idle_timeout)
+                        if self.max_pending == 1:
+                            self._cond.notify()
+                        else:
+                            # a shared socket can take all the waiters
+                            self._cond.notify_all()
+                    break
 
-    def _get_next(self):
+    def _discard(self, conn):
+        """Closes a checked out socket that failed its health check, e.g.
+        because the server closed it for idleness."""
+
+        with self._cond:
+            for node in self._nodes + self._draining:
+                sock = node.find(conn)
+                if sock:
+                    node.remove(sock)
+                    if node in self._draining and not node.sockets:
+                        self._draining.remove(node)
+                    self._cond.notify_all()
+                    break
+
+    def _acquire(self, deadline, owner=None):
+        """Checks out a socket, returns it and whether it was idle long
+        enough to be health checked."""
+
+        with self._cond:
+            while True:
+                node, sock = self._get_next(owner)
+                if sock:
+                    now = time.time()
+                    idle = (self.health_check is not None and
+                            sock.pending == 0 and
+                            now - sock.used > self.health_check_interval)
+                    sock.pending += 1
+                    sock.used = now
+                    return sock.conn, idle
+                if node:
+                    break
+                now = time.time()
+                retry_at = self._retry_at(now)
+                if retry_at is not None and retry_at >= deadline:
+                    # no node comes back in time
+                    raise error.UnavailableError("No server available.")
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise error.UnavailableError(
+                        "Timeout waiting for a free connection.")
+                # all sockets of all available nodes are busy, or the nodes
+                # are out of selection until retry_at
+                if retry_at is not None:
+                    remaining = min(remaining, retry_at - now)
+                self._cond.wait(remaining)
+            # reserve a new socket and open it without holding the lock
+            sock = node.grow()
+            sock.pending = 1
+
+        try:
+            sock.conn.connect()
+        except error.ConnectionError:
+            with self._cond:
+                node.sockets.remove(sock)
+                self._fail(node)
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            node.failures = 0
+            # requests that came meanwhile may share the socket
+            self._cond.notify_all()
+        return sock.conn, False
+
+    def _healthy(self, conn):
+        try:
+            healthy = self.health_check(conn)
+        except Exception:
+            # whatever failed, the socket can't be trusted and must still be
+            # checked in
+            healthy = False
+        if not healthy:
+            conn.broken = True
+        return healthy
+
+    def _retry_at(self, now):
+        """Returns the time the first node comes back to selection if all
+        nodes are out of it, :obj:`None` otherwise."""
+        if any(node.retry_at <= now for node in self._nodes):
+            return None
+        return min(node.retry_at for node in self._nodes)
+
+    def _fail(self, node):
+        """Takes a failed node out of selection for a while."""
+
+        node.failures += 1
+        backoff = min(self.backoff_base * 2 ** (node.failures - 1),
+                      self.backoff_max)
+        # jitter spreads reconnects of many clients after a node restart
+        node.retry_at = time.time() + backoff * random.uniform(0.5, 1)
+
+    def _get_next(self, owner=None):
+        """Picks the first node in the order of the selection strategy, or
+        the owner node, that has capacity and returns it with its idle
+        socket, or with None if it can open one more socket, or with its
+        least busy socket. Nodes out of selection are skipped, fails if there
+        are no nodes at all."""
+
+        if not self._nodes:
+            raise error.UnavailableError("No server available.")
+        now = time.time()
+        nodes = [node for node in self._nodes if node.retry_at <= now]
+        if not nodes:
+            return None, None
+        # nodes still being connected to are used only if there's no other
+        warm = [node for node in nodes if not node.warming]
+        if warm:
+            nodes = warm
+        order = self.strategy.order(nodes)
+        if owner is not None:
+            preferred = [node for node in nodes if node.address == owner]
+            order = preferred + [node for node in order
+                                 if node not in preferred]
+        for node in order:
+            sock = node.available(self.max_pending)
+            if sock and sock.pending == 0:
+                return node, sock
+            if len(node.sockets) < self.max_size:
+                return node, None
+            if sock:
+                return node, sock
+        return None, None
+
+
+class RoundRobin(object):
+    """Selects nodes in turns.
+
+    A selection strategy orders the nodes in which they are tried by a
+    connection pool. Every node has attributes `conn` (the connection the
+    node was created with), `pending` (number of requests in flight) and
+    `latency` (moving average of request durations in seconds or
+    :obj:`None` if not known yet). Strategies are called with the pool's
+    lock held.
+    """
+
+    def __init__(self):
+        self._next = 0
+
+    def order(self, nodes):
+        i = self._next % len(nodes)
+        self._next = i + 1
+        return nodes[i:] + nodes[:i]
+
+
+class LeastPending(object):
+    """Selects the node with the least requests in flight."""
+
+    def order(self, nodes):
+        # shuffled first so that ties are broken randomly
+        nodes = list(nodes)
+        random.shuffle(nodes)
+        nodes.sort(key=lambda node: node.pending)
+        return nodes
+
+
+class PowerOfTwoChoices(object):
+    """Selects the better of two random nodes, the one with lower latency
+    multiplied by the number of requests in flight. Nodes with unknown
+    latency are preferred so that they are measured."""
+
+    def order(self, nodes):
+        if len(nodes) < 2:
+            return nodes
+        a, b = random.sample(nodes, 2)
+        if self._cost(b) < self._cost(a):
+            a, b = b, a
+        return [a, b] + [node for node in nodes
+                         if node is not a and node is not b]
+
+    @staticmethod
+    def _cost(node):
+        return (node.latency or 0) * (node.pending + 1)
+
+
+class WeightedRoundRobin(object):
+    """Selects nodes in turns, each node as often as its weight says.
+
+    :param weight: Function returning weight of a node. By default, the
+                   weight is the inverse of the node's latency, nodes with
+                   unknown latency get the average one.
+    """
+
+    def __init__(self, weight=None):
+        self.weight = weight
+        # current weights of the smooth weighted round-robin by node
+        self._current = {}
+
+    def order(self, nodes):
+        weights = self._weights(nodes)
+        total = sum(weights)
+        current = dict((node, self._current.get(node, 0) + w)
+                       for node, w in zip(nodes, weights))
+        best = max(nodes, key=lambda node: current[node])
+        current[best] -= total
+        self._current = current
+        return [best] + [node for node in nodes if node is not best]
+
+    def _weights(self, nodes):
+        if self.weight is not None:
+            return [self.weight(node) for node in nodes]
+        latencies = [node.latency for node in nodes]
+        known = [latency for latency in latencies if latency]
+        default = sum(known) / len(known) if known else 1.0
+        return [1.0 / max(latency or default, 1e-6) for latency in latencies]
+
+
+class RetryPolicy(object):
+    """Decides whether a request failed on a broken connection is retried.
+
+    Attempts of a request are capped and all of them must fit into the
+    request's original deadline. Besides, retries are throttled by a budget
+    shared by all requests so that they can't amplify an outage: every
+    failure takes one token from the budget, every success puts back
+    `token_ratio` of a token and retries are allowed only while more than
+    half of `max_tokens` is left.
+
+    :param max_attempts: Maximum number of attempts of a request, including
+                         the first one. Use 1 to disable retries.
+    :param max_tokens: Size of the retry budget.
+    :param token_ratio: Tokens returned to the budget by a success.
+    """
+
+    def __init__(self, max_attempts=3, max_tokens=10, token_ratio=0.1):
+        self.max_attempts = max_attempts
+        self.max_tokens = max_tokens
+        self.token_ratio = token_ratio
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def should_retry(self, attempts, deadline):
+        """Records a failed attempt and returns whether the request should
+        be tried again.
+
+        :param attempts: Number of attempts made so far.
+        :param deadline: Time by which the request must complete.
+        """
+        with self._lock:
+            self.tokens = max(self.tokens - 1, 0)
+            throttled = self.tokens <= self.max_tokens / 2.0
+        return (not throttled and attempts < self.max_attempts and
+                time.time() < deadline)
+
+    def succeeded(self):
+        """Records a successful request."""
         with self._lock:
-            if self._curr >= self.size - 1:
-                self._curr = 0
-            else:
-                self._curr += 1
-            return self._connections[self._curr]
+            self.tokens = min(self.tokens + self.token_ratio, self.max_tokens)
+
+
+class _Socket(object):
+    """Socket of a node in a connection pool."""
+
+    __slots__ = ('conn', 'pending', 'used')
+
+    def __init__(self, conn, pending=0):
+        self.conn = conn
+        self.pending = pending
+        self.used = time.time()
+
+
+class _Node(object):
+    """Sockets of one server node."""
+
+    __slots__ = ('conn', 'address', 'sockets', 'failures', 'retry_at',
+                 'warming', '_spare')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.address = (conn.host, conn.port)
+        self.sockets = []
+        self.failures = 0
+        # time until which the node is out of selection
+        self.retry_at = 0
+        # set while a new node is being connected to in background
+        self.warming = False
+        # the connection the node was created with is opened first
+        self._spare = conn
+
+    @property
+    def pending(self):
+        return sum(sock.pending for sock in self.sockets)
+
+    @property
+    def latency(self):
+        latencies = [sock.conn.latency for sock in self.sockets
+                     if sock.conn.latency is not None]
+        return sum(latencies) / len(latencies) if latencies else None
+
+    def fill(self, size):
+        while len(self.sockets) < size:
+            sock = self.grow()
+            try:
+                sock.conn.connect()
+            except error.ConnectionError:
+                self.sockets.remove(sock)
+                raise
+
+    def take(self):
+        """Returns a new unconnected connection to the node."""
+        if self._spare is not None:
+            conn, self._spare = self._spare, None
+            return conn
+        return self.conn.copy()
+
+    def grow(self):
+        sock = _Socket(self.take())
+        self.sockets.append(sock)
+        return sock
+
+    def find(self, conn):
+        for sock in self.sockets:
+            if sock.conn is conn:
+                return sock
+
+    def available(self, max_pending):
+        """Returns a connected socket with the least pending requests that can
+        take one more."""
+
+        best = None
+        for sock in self.sockets:
+            if not sock.conn.connected:
+                continue
+            if max_pending is not None and sock.pending >= max_pending:
+                continue
+            if best is None or sock.pending < best.pending:
+                best = sock
+        return best
+
+    def reap(self, size, idle_since):
+        for sock in list(self.sockets[size:]):
+            if sock.pending == 0 and sock.used <= idle_since:
+                self.remove(sock)
+
+    def evict(self, sock):
+        self.remove(sock)
+        self.drain()
+
+    def drain(self):
+        """Closes idle sockets."""
+        for idle in [s for s in self.sockets if s.pending == 0]:
+            self.remove(idle)
+
+    def close(self):
+        for sock in list(self.sockets):
+            self.remove(sock)
+        self._spare = self.conn
+        self.failures = 0
+        self.retry_at = 0
+
+    def remove(self, sock):
+        self.sockets.remove(sock)
+        if sock.conn.connected:
+            sock.conn.disconnect()
@@ -5,6 +5,12 @@ class DecodeError(Exception):
     pass
 
 
+class IncompleteError(DecodeError):
+    def __init__(self, message, needed):
+        super(IncompleteError, self).__init__(message)
+        self.needed = needed
+
+
 class EncodeError(Exception):
     pass
 
@@ -13,6 +19,11 @@ class ConnectionError(Exception):
     pass
 
 
+class UnavailableError(ConnectionError):
+    """No connection could be obtained, the request was not sent."""
+    pass
+
+
 class ResponseError(Exception):
     def __init__(self, message, response):
         super(ResponseError, self).__init__(message)
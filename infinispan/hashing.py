@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+import struct
+import threading
+
+from array import array
+from collections import OrderedDict
+
+
+_MASK = 0xFFFFFFFFFFFFFFFF
+_INT_MAX = 0x7FFFFFFF
+_BLOCK = struct.Struct('<QQ')
+_SIGNS = 0x8080808080808080
+# bits above each byte of a 64-bit word
+_ABOVE = [_MASK ^ ((1 << (j * 8 + 8)) - 1) for j in range(8)]
+
+# seed Infinispan uses for hashing keys
+SEED = 9001
+
+# longer keys are hashed every time, not cached
+MAX_CACHED_KEY_SIZE = 256
+
+
+def murmur3(data, seed=SEED):
+    """Computes 32-bit MurmurHash3 of the data the same way Infinispan does
+    (`MurmurHash3_x64_32`), i.e. upper half of the first 64 bits of its
+    x64 variant of MurmurHash3.
+
+    :param data: Byte array to be hashed.
+    :param seed: Hash seed.
+    :return: Hash as unsigned 32-bit integer.
+    """
+
+    length = len(data)
+    tail = length & ~15
+    blocks = [_BLOCK.unpack_from(data, i) for i in range(0, tail, 16)]
+    if length & 15:
+        blocks.append(_tail(data[tail:]))
+
+    # mixing steps are inlined, function calls would double the time
+    mask = _MASK
+    h1 = 0x9368e53c2f6af274 ^ seed
+    h2 = 0x586dcd208f7cd3fd ^ seed
+    c1 = 0x87c37b91114253d5
+    c2 = 0x4cf5ad432745937f
+    for k1, k2 in blocks:
+        k1 = (k1 * c1) & mask
+        k1 = ((k1 << 23) | (k1 >> 41)) & mask
+        h1 ^= (k1 * c2) & mask
+        h1 = (h1 + h2) & mask
+        h2 = ((h2 << 41) | (h2 >> 23)) & mask
+        k2 = (k2 * c2) & mask
+        k2 = ((k2 << 23) | (k2 >> 41)) & mask
+        h2 ^= (k2 * c1) & mask
+        h2 = (h2 + h1) & mask
+        h1 = (h1 * 3 + 0x52dce729) & mask
+        h2 = (h2 * 3 + 0x38495ab5) & mask
+        c1 = (c1 * 5 + 0x7b7d159c) & mask
+        c2 = (c2 * 5 + 0x6bce6396) & mask
+
+    h2 ^= length
+    h1 = (h1 + h2) & mask
+    h2 = (h2 + h1) & mask
+    h1 = _fmix(h1)
+    h2 = _fmix(h2)
+    return ((h1 + h2) & mask) >> 32
+
+
+def _tail(data):
+    """Returns the last incomplete block as two 64-bit words. Java bytes are
+    signed, so every byte is sign-extended before it is xored in."""
+
+    block = bytearray(data)
+    block += b'\x00' * (16 - len(block))
+    words = list(_BLOCK.unpack_from(block))
+    for w in (0, 1):
+        # sign extension of a negative byte flips all bits above it
+        signs = words[w] & _SIGNS
+        if signs:
+            for j in range(8):
+                if (signs >> (j * 8 + 7)) & 1:
+                    words[w] ^= _ABOVE[j]
+    return words
+
+
+def _fmix(k):
+    k ^= k >> 33
+    k = (k * 0xff51afd7ed558ccd) & _MASK
+    k ^= k >> 33
+    k = (k * 0xc4ceb9fe1a85ec53) & _MASK
+    k ^= k >> 33
+    return k
+
+
+def hash_key(key):
+    """Returns :func:`murmur3` of a serialized key, hashes of recently used
+    keys are cached."""
+
+    if len(key) > MAX_CACHED_KEY_SIZE or not isinstance(key, bytes):
+        return murmur3(key)
+    h = _hashes.get(key)
+    if h is None:
+        h = murmur3(key)
+        _hashes.put(key, h)
+    return h
+
+
+class LRUCache(object):
+    """Cache of limited size that discards least recently used items first.
+    Safe to be used by multiple threads."""
+
+    def __init__(self, size=1024):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.pop(key, _MISSING)
+            if value is _MISSING:
+                return default
+            # re-inserted as the most recently used
+            self._data[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+_MISSING = object()
+_hashes = LRUCache()
+
+
+class ConsistentHash(object):
+    """Segment based consistent hash of a cluster, as sent by the server to
+    clients with hash intelligence. Maps keys to their owners.
+
+    Owners of all segments are kept in one flat array, the owners of segment
+    `i` are at positions `offsets[i]` to `offsets[i + 1]`.
+    """
+
+    def __init__(self, hosts, segments):
+        """Creates new consistent hash.
+
+        :param hosts: Addresses of cluster members, (host, port) tuples.
+        :param segments: List of segments, each segment is a list of indexes
+                         of its owners in hosts, primary owner first.
+        """
+        self.hosts = tuple(hosts)
+        self.owners = array('i')
+        self.offsets = array('i', [0])
+        for owners in segments:
+            self.owners.extend(owners)
+            self.offsets.append(len(self.owners))
+        self.segments_n = len(self.offsets) - 1
+        # segments split the positive part of the hash space evenly
+        self.segment_size = -(-_INT_MAX // self.segments_n) \
+            if self.segments_n else 0
+
+    def segment(self, key):
+        """Returns segment of a serialized key."""
+        return (hash_key(key) & _INT_MAX) // self.segment_size
+
+    def primary_owner(self, key):
+        """Returns address of the primary owner of a serialized key or
+        :obj:`None` if the segment of the key has no owner."""
+        if not self.segments_n:
+            return None
+        return self.segment_owner(self.segment(key))
+
+    def segment_owner(self, segment):
+        """Returns address of the primary owner of a segment or :obj:`None`
+        if the segment has no owner."""
+        start = self.offsets[segment]
+        if start == self.offsets[segment + 1]:
+            return None
+        return self.hosts[self.owners[start]]
+
+    def key_owners(self, key):
+        """Returns addresses of all owners of a serialized key, primary owner
+        first."""
+        if not self.segments_n:
+            return []
+        segment = self.segment(key)
+        return [self.hosts[i] for i in
+                self.owners[self.offsets[segment]:self.offsets[segment + 1]]]
@@ -4,7 +4,7 @@ import time
 import threading
 import logging
 
-from collections import OrderedDict
+from future.utils import with_metaclass
 
 from infinispan import messenger as m
 from infinispan import codec
@@ -19,6 +19,10 @@ class ClientIntelligence(object):
     HASH = 0x03
 
 
+class HashFunction(object):
+    MURMUR3 = 0x03
+
+
 class TimeUnits(object):
     SECONDS = 0x00
     MILISECONDS = 0x01
@@ -87,6 +91,30 @@ class ResponseHeader(m.Message):
     tc = m.Composite(default=TopologyChangeHeader, condition=lambda s: s.tcm)
 
 
+class SegmentOwner(m.Message):
+    index = m.Uvarint()
+
+
+class Segment(m.Message):
+    n = m.Byte()
+    owners = m.List(of=SegmentOwner, size=lambda s: s.n)
+
+
+class HashTopologyChangeHeader(TopologyChangeHeader):
+    """Topology change header sent to clients with hash intelligence."""
+    hf_version = m.Byte(default=0)
+    # sent even without hash function, i.e. for non-distributed caches
+    segments_n = m.Uvarint(default=0)
+    segments = m.List(of=Segment, size=lambda s: s.segments_n,
+                      condition=lambda s: s.hf_version)
+
+
+class HashResponseHeader(ResponseHeader):
+    """Response header of requests sent with hash intelligence."""
+    tc = m.Composite(
+        default=HashTopologyChangeHeader, condition=lambda s: s.tcm)
+
+
 class Request(m.Message):
     header = m.Composite(default=RequestHeader)
 
@@ -95,7 +123,21 @@ class Request(m.Message):
         self.header.op = self.OP_CODE
 
 
-class Response(m.Message):
+# response classes indexed by operation code, filled in by ResponseMeta
+RESPONSE_TYPES = [None] * 0x100
+
+
+class ResponseMeta(m.MessageMeta):
+    """Registers response classes in :data:`RESPONSE_TYPES` as they are
+    defined."""
+
+    def __init__(cls, name, bases, attrs):
+        super(ResponseMeta, cls).__init__(name, bases, attrs)
+        if 'OP_CODE' in attrs:
+            RESPONSE_TYPES[attrs['OP_CODE']] = cls
+
+
+class Response(with_metaclass(ResponseMeta, m.Message)):
     header = m.Composite(default=ResponseHeader)
 
     def __init__(self, **kwargs):
@@ -264,84 +306,261 @@ class GetWithMetadataResponse(Response):
     value = m.Varbytes(condition=lambda s: s.header.status == Status.OK)
 
 
+class Key(m.Message):
+    key = m.Varbytes()
+
+
+class Entry(m.Message):
+    key = m.Varbytes()
+    value = m.Varbytes()
+
+
+class GetAllRequest(Request):
+    OP_CODE = 0x2F
+    n = m.Uvarint()
+    keys = m.List(of=Key, size=lambda s: s.n)
+
+
+class GetAllResponse(Response):
+    OP_CODE = 0x30
+    n = m.Uvarint()
+    entries = m.List(of=Entry, size=lambda s: s.n)
+
+
+class PutAllRequest(Request):
+    OP_CODE = 0x2D
+    tunits = m.SplitByte(default=[TimeUnits.DEFAULT, TimeUnits.DEFAULT])
+    lifespan = m.Uvarint(default=10, condition=lambda s: s.tunits[0] not in
+                         [TimeUnits.DEFAULT, TimeUnits.INFINITE])
+    max_idle = m.Uvarint(default=10, condition=lambda s: s.tunits[1] not in
+                         [TimeUnits.DEFAULT, TimeUnits.INFINITE])
+    n = m.Uvarint()
+    entries = m.List(of=Entry, size=lambda s: s.n)
+
+
+class PutAllResponse(Response):
+    OP_CODE = 0x2E
+
+
+class IterationStartRequest(Request):
+    OP_CODE = 0x31
+    # segments to iterate as a bit set, all segments if None
+    segments = m.NullableVarbytes(optional=True)
+    filter_converter = m.NullableVarbytes(optional=True)
+    params_n = m.Byte(default=0,
+                      condition=lambda s: s.filter_converter is not None)
+    batch_size = m.Uvarint(default=100)
+    metadata = m.Byte(default=0)
+
+
+class IterationStartResponse(Response):
+    OP_CODE = 0x32
+    iteration_id = m.String()
+
+
+class IterationNextRequest(Request):
+    OP_CODE = 0x33
+    iteration_id = m.String()
+
+
+class IterationEntry(m.Message):
+    # metadata follows only if requested when the iteration started
+    meta = m.Byte()
+    flag = m.Byte(condition=lambda s: s.meta == 1)
+    created = m.Long(condition=lambda s: s.meta == 1 and not(s.flag & 0x01))
+    lifespan = m.Uvarint(
+        condition=lambda s: s.meta == 1 and not(s.flag & 0x01))
+    last_used = m.Long(
+        condition=lambda s: s.meta == 1 and not(s.flag & 0x02))
+    max_idle = m.Uvarint(
+        condition=lambda s: s.meta == 1 and not(s.flag & 0x02))
+    version = m.Bytes(8, condition=lambda s: s.meta == 1)
+    key = m.Varbytes()
+    value = m.Varbytes()
+
+
+class IterationNextResponse(Response):
+    OP_CODE = 0x34
+    finished_segments = m.Varbytes()
+    n = m.Uvarint()
+    projections_n = m.Uvarint(condition=lambda s: s.n)
+    entries = m.List(of=IterationEntry, size=lambda s: s.n)
+
+
+class IterationEndRequest(Request):
+    OP_CODE = 0x35
+    iteration_id = m.String()
+
+
+class IterationEndResponse(Response):
+    OP_CODE = 0x36
+
+
 class ErrorResponse(Response):
     OP_CODE = 0x50
     error_message = m.String()
 
 
 class Protocol(object):
-    """Low level API that sends requests and blocks until response received."""
+    """Low level API that sends requests and blocks until response received.
 
-    def __init__(self, conn, timeout=10):
+    Requests are pipelined, many requests can wait for a response on the same
+    connection at once. One of the waiting threads at a time reads responses
+    from the connection and hands them over to the waiting threads by id.
+    """
+
+    def __init__(self, conn, timeout=10, max_pending=1024,
+                 intelligence=ClientIntelligence.TOPOLOGY):
         """Creates new protocol instance.
 
         :param conn: Connection, you need to open the connection yourself
                      before you can send requests and close it when you are
                      done.
+        :param max_pending: Maximum number of requests waiting for a response
+                            at once, further requests fail immediately.
+        :param intelligence: Client intelligence of sent requests, responses
+                             to requests with hash intelligence carry
+                             topology changes with hash information.
         """
         self.lock = threading.Lock()
         self.conn = conn
         self.timeout = timeout
+        self.max_pending = max_pending
+        # number of responses received after their request was abandoned
+        self.dropped = 0
         self._id = 0
-        self._responses = OrderedDict()
-        self._decoder_f = codec.DecoderFactory()
+        # requests waiting for a response by id, an entry lives only as long
+        # as its sender waits, so the table never outgrows max_pending
+        self._pending = {}
+        self._decoder_f = codec.DecoderFactory(
+            header_type=HashResponseHeader
+            if intelligence == ClientIntelligence.HASH else ResponseHeader)
         self._encoder_f = codec.EncoderFactory()
 
-    def send(self, request):
+    def send(self, request, template=None, conn=None, owner=None,
+             deadline=None):
         """Sends a request to the server.
 
         :param request: Request to be sent to the associated Infinispan server.
+        :param template: Pre-encoded header (:class:`codec.HeaderTemplate`)
+                         to be used instead of encoding the request header.
+        :param conn: Connection to be used instead of one from the protocol's
+                     connection (pool), e.g. to check health of a connection.
+        :param owner: Address (host, port) of the server node the request
+                      should preferably be sent to, e.g. owner of the key.
+        :param deadline: Time (as returned by :func:`time.time`) by which the
+                         response must arrive, protocol's timeout from now
+                         by default.
         :return: Response from the server.
         """
 
-        # encode request
         req_id = self._get_next_id()
         request.header.id = req_id
-        encoder = self._encoder_f.get()
-        encoded_request = encoder.encode(request)
 
+        if deadline is None:
+            deadline = time.time() + self.timeout
         # send request and wait until received the correct response
-        with self.conn.context() as ctx:
-            log.debug("Sending request id=%r encoded as %r to %s",
-                      req_id, encoded_request, ctx)
-            ctx.send(encoded_request)
-            # receive and decode
-            decoder = self._decoder_f.get()
-            with ctx.lock:
-                data = ctx.recv()
-                response = decoder.decode(data)
+        with (conn or self.conn).context(owner, deadline) as ctx:
+            # encoded only after checkout, the health check of the checked
+            # out connection sends a request using the same encoder
+            encoder = self._encoder_f.get()
+            encoded_request = encoder.encode_buffers(
+                request, template=template)
+            pending = _Pending(req_id, ctx)
+            with self.lock:
+                if len(self._pending) >= self.max_pending:
+                    log.error("Too many pending requests, rejecting id=%r",
+                              req_id)
+                    raise error.UnavailableError("Too many pending requests.")
+                self._pending[req_id] = pending
+            try:
+                log.debug("Sending request id=%r encoded in %d bytes to %s",
+                          req_id, sum(map(len, encoded_request)), ctx)
+                start = time.time()
+                ctx.send(encoded_request)
+                self._wait(pending, deadline)
+                if pending.response is not None:
+                    ctx.observe(time.time() - start)
+            finally:
+                with self.lock:
+                    del self._pending[req_id]
+
+        if pending.error:
+            raise pending.error
+        return pending.response
+
+    def _wait(self, pending, deadline):
+        ctx = pending.conn
+        while not pending.done:
+            # become the reader of the connection unless someone else is
+            if ctx.lock.acquire(False):
+                try:
+                    self._read(pending, deadline)
+                finally:
+                    ctx.lock.release()
+                    self._wake_reader(ctx, pending)
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    log.error("Timeout waiting on response with id=%r",
+                              pending.id)
+                    raise error.ConnectionError("Timeout.")
+                pending.event.wait(remaining)
+                pending.event.clear()
+
+    def _read(self, pending, deadline):
+        ctx = pending.conn
+        decoder = self._decoder_f.get()
+        while not pending.done:
+            if time.time() > deadline:
+                log.error("Timeout waiting on response with id=%r",
+                          pending.id)
+                raise error.ConnectionError("Timeout.")
+            try:
+                response = decoder.decode(ctx.recv())
+            except (error.ConnectionError, error.DecodeError) as ex:
+                # the stream cannot be read any further, the connection
+                # must not be reused
+                ctx.broken = True
+                self._fail(ctx, ex)
+                raise
             log.debug("Received response id=%r from %s",
                       response.header.id, ctx)
-            self._cache_resp(response)
 
-        mustend = time.time() + self.timeout
-        while req_id not in self._responses:
-            # if there is an error response in the cache, raise an error
-            err_resp = self._pop_resp(0)
-            if err_resp:
+            resp_id = response.header.id
+            if resp_id == 0 and isinstance(response, ErrorResponse):
                 log.error("Received server error without id, message: %s",
-                          err_resp.error_message)
-                raise error.ServerError(err_resp.error_message, err_resp)
+                          response.error_message)
+                raise error.ServerError(response.error_message, response)
+            with self.lock:
+                waiting = self._pending.get(resp_id)
+                if not waiting:
+                    self.dropped += 1
+            if waiting:
+                waiting.complete(response)
+            else:
+                log.debug("Dropped response id=%r of an abandoned request",
+                          resp_id)
+
+    def _wake_reader(self, ctx, reader):
+        """Wakes up a thread waiting on the connection so that it takes over
+        reading from the reader, who is not woken up again even if it gave
+        up without its response."""
 
-            time.sleep(0.005)
-            if time.time() > mustend:
-                log.error("Timeout waiting on response with id=%r", req_id)
-                raise error.ConnectionError("Timeout.")
-        return self._pop_resp(req_id)
-
-    def _cache_resp(self, response):
         with self.lock:
-            if len(self._responses) > 100:
-                self._responses = dict(
-                    self._responses.items()[:len(self._responses)/2])
-            self._responses[response.header.id] = response
+            for pending in self._pending.values():
+                if pending.conn is ctx and pending is not reader and \
+                        not pending.done:
+                    pending.event.set()
+                    break
+
+    def _fail(self, ctx, ex):
+        """Fails all requests waiting on a connection that cannot be read."""
 
-    def _pop_resp(self, id):
         with self.lock:
-            if id in self._responses:
-                resp = self._responses[id]
-                del self._responses[id]
-                return resp
+            for pending in self._pending.values():
+                if pending.conn is ctx:
+                    pending.complete(error=ex)
 
     def _get_next_id(self):
         with self.lock:
@@ -349,3 +568,25 @@ class Protocol(object):
                 self._id = 0
             self._id += 1
             return self._id
+
+
+class _Pending(object):
+    """Request waiting for a response."""
+
+    __slots__ = ('id', 'conn', 'event', 'response', 'error')
+
+    def __init__(self, id, conn):
+        self.id = id
+        self.conn = conn
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+
+    @property
+    def done(self):
+        return self.response is not None or self.error is not None
+
+    def complete(self, response=None, error=None):
+        self.response = response
+        self.error = error
+        self.event.set()
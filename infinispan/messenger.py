@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+from future.utils import with_metaclass
+
 
 class CreatedCounter(object):
     _count = 0
@@ -23,26 +25,53 @@ class DataType(object):
         return type(self).__name__.lower()
 
 
-class Message(object):
-    def __init__(self, **kwargs):
-        m_fields = filter(
-            lambda f: not f.startswith('__') and
-            isinstance(getattr(self, f), DataType), dir(self))
+class MessageMeta(type):
+    """Collects fields of a message when its class is created.
+
+    Fields (instances of :class:`DataType`) are removed from the class
+    namespace, stored in attribute `types` (field name -> data type) and
+    ordered by creation in attribute `fields`. Instances keep field values in
+    slots.
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        types = {}
+        for base in reversed(bases):
+            types.update(getattr(base, 'types', {}))
 
-        self.fields = \
-            sorted(m_fields, key=lambda fn: getattr(self, fn)._created)
+        new_fields = [f_name for f_name, f_cls in attrs.items()
+                      if isinstance(f_cls, DataType)]
+        for f_name in new_fields:
+            types[f_name] = attrs.pop(f_name)
 
-        for f_name in self.fields:
-            f_cls = getattr(self.__class__, f_name)
+        attrs['__slots__'] = tuple(new_fields)
+        attrs['types'] = types
+        attrs['fields'] = sorted(types, key=lambda fn: types[fn]._created)
+        attrs['_defaults'] = tuple(
+            (f_name, mcs._default(types[f_name]))
+            for f_name in attrs['fields'])
+        return super(MessageMeta, mcs).__new__(mcs, name, bases, attrs)
+
+    @staticmethod
+    def _default(f_cls):
+        """Returns a factory of the default value of a field."""
+        if not hasattr(f_cls, 'default'):
+            return lambda: None
+        default = f_cls.default
+        if f_cls.type == "composite":
+            return default
+        elif isinstance(default, list):
+            return lambda: list(default)
+        return lambda: default
+
+
+class Message(with_metaclass(MessageMeta, object)):
+    def __init__(self, **kwargs):
+        for f_name, default in self._defaults:
             if f_name in kwargs:
                 setattr(self, f_name, kwargs[f_name])
-            elif hasattr(f_cls, 'default'):
-                default = f_cls.default
-                if f_cls.type == "composite":
-                    default = f_cls.default()
-                setattr(self, f_name, default)
             else:
-                setattr(self, f_name, None)
+                setattr(self, f_name, default())
 
     @property
     def cls(self):
@@ -71,6 +100,12 @@ class Varbytes(DataType):
     pass
 
 
+class NullableVarbytes(DataType):
+    """Byte array prefixed by its length as :class:`Varint`, length -1
+    stands for :obj:`None`."""
+    pass
+
+
 class SplitByte(DataType):
     pass
 
@@ -87,6 +122,11 @@ class Uvarlong(DataType):
     pass
 
 
+class Varint(DataType):
+    """Signed variable length integer, zig-zag encoded."""
+    pass
+
+
 class String(DataType):
     pass
 
@@ -14,6 +14,16 @@ class Serialization(object):
     def deserialize(self, byte_array):
         raise NotImplementedError
 
+    def serialize_many(self, objs):
+        """Serializes every object of a sequence, returns list of byte
+        arrays."""
+        return list(map(self.serialize, objs))
+
+    def deserialize_many(self, byte_arrays):
+        """Deserializes every byte array of a sequence, returns list of
+        objects."""
+        return list(map(self.deserialize, byte_arrays))
+
 
 class UTF8(Serialization):
     def serialize(self, string):
@@ -40,3 +50,12 @@ class JSONPickle(Serialization):
             return jsonpickle.decode(byte_array.decode("UTF-8"))
         else:
             return None
+
+    def serialize_many(self, objs):
+        encode = jsonpickle.encode
+        return [encode(obj).encode("UTF-8") for obj in objs]
+
+    def deserialize_many(self, byte_arrays):
+        decode = jsonpickle.decode
+        return [decode(b.decode("UTF-8")) if b else None
+                for b in byte_arrays]
@@ -33,6 +33,17 @@ def from_pretty_time(time):
     return duration, unit
 
 
+def to_bitset(numbers):
+    """Encodes non-negative integers as a bit set the same way Java's
+    `BitSet.toByteArray` does, i.e. bit `n % 8` of byte `n // 8` is set for
+    every number `n`."""
+    numbers = list(numbers)
+    bitset = bytearray(max(numbers) // 8 + 1 if numbers else 0)
+    for n in numbers:
+        bitset[n // 8] |= 1 << (n % 8)
+    return bytes(bitset)
+
+
 def get_all_subclasses(cls):
     all_subclasses = []
 
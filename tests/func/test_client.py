@@ -263,6 +263,44 @@ class TestClientStandalone(object):
         client.put("key1", "value1")
         assert client.contains_key("key1") is True
 
+    def test_get_many(self, client):
+        client.put("key1", "value1")
+        client.put("key2", "value2")
+
+        result = client.get_many(["key1", "key2", "notexisting"])
+        assert result == {"key1": "value1", "key2": "value2"}
+
+    def test_put_many(self, client):
+        entries = {"key%d" % i: "value%d" % i for i in range(10)}
+        result = client.put_many(entries, chunk_size=3)
+
+        assert result is True
+        assert client.get_many(entries) == entries
+
+    def test_put_many_from_iterator(self, client):
+        result = client.put_many(
+            (("key%d" % i, i) for i in range(10)), lifespan='2s')
+
+        assert result is True
+        assert client.get("key9") == 9
+        time.sleep(2)
+        assert client.get("key9") is None
+
+    def test_iterate(self, client):
+        client.clear()
+        entries = {"key%d" % i: "value%d" % i for i in range(10)}
+        client.put_many(entries)
+
+        assert dict(client.iterate(batch_size=3)) == entries
+
+    def test_iterate_with_metadata(self, client):
+        client.clear()
+        client.put("key1", "value1", lifespan='10s')
+
+        [(key, value, metadata)] = list(client.iterate(with_metadata=True))
+        assert (key, value) == ("key1", "value1")
+        assert metadata["lifespan"] == 10
+
     def test_put_to_different_cache(self, client):
         client.cache_name = "memcachedCache"
         result = client.put("key2", "value2")
@@ -329,3 +367,19 @@ class TestClientDomain(object):
         assert client.protocol.conn.size == 1
         assert client.ping()
         assert client.protocol.conn.size == 2
+
+    def test_get_many_with_topology_change(self, client):
+        keys = ["key%d" % i for i in range(20)]
+        for key in keys:
+            client.put(key, key)
+        assert client.protocol.conn.size == 2
+
+        assert client.get_many(keys) == {key: key for key in keys}
+
+    def test_iterate_with_topology_change(self, client):
+        client.clear()
+        entries = {"key%d" % i: i for i in range(20)}
+        client.put_many(entries)
+        assert client.protocol.conn.size == 2
+
+        assert dict(client.iterate(batch_size=5)) == entries
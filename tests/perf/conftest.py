@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+# (test name, ops/sec, bytes/sec) of benchmarks run with `throughput`
+_THROUGHPUT = []
+
+
+@pytest.fixture
+def throughput(request, benchmark):
+    """Benchmarks a function that processes given number of bytes and reports
+    ops/sec and bytes/sec at the end of the session. Both are also stored in
+    `extra_info` of the saved benchmark.
+    """
+
+    def run(function, size):
+        result = benchmark(function)
+        if benchmark.stats:
+            mean = benchmark.stats['mean']
+            benchmark.extra_info['bytes'] = size
+            benchmark.extra_info['bytes_per_sec'] = size / mean
+            _THROUGHPUT.append((request.node.name, 1 / mean, size / mean))
+        return result
+    return run
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not _THROUGHPUT:
+        return
+    terminalreporter.write_sep("-", "throughput")
+    for name, ops, bps in _THROUGHPUT:
+        terminalreporter.write_line("%-60s %14.1f ops/s %12.2f MB/s" % (
+            name, ops, bps / 2**20))
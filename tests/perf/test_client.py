@@ -59,16 +59,16 @@ class TestClientWithMockConnection(object):
             conn._s = MagicMock()
         conn.connect = connect
 
-        def send(byte_array):
+        def send(buffers):
             time.sleep(0.001)
-            bts = byte_array[1:len(byte_array)-6]
-            conn._ids.append(bts)
+            byte_array = b''.join(memoryview(b).tobytes() for b in buffers)
+            conn._ids.append(byte_array[1:len(byte_array)-6])
         conn.send = send
 
         def recv():
             time.sleep(0.003)
             r = b'\xa1' + conn._ids.popleft() + b'\x18\x00\x00'
-            result = iter(r)
+            result = iter(bytearray(r))
             while True:
                 yield struct.pack(">B", next(result))
         conn.recv = recv
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from infinispan import codec, hotrod
+from infinispan.hotrod import Status
+
+# 16 B to 16 MB
+SIZES = [16, 256, 4096, 65536, 2**20, 2**24]
+VERSION = b'\x00\x00\x00\x00\x00\x00\x00\x01'
+
+REQUESTS = {
+    'put': lambda p: hotrod.PutRequest(key=b'key', value=p),
+    'put_if_absent': lambda p: hotrod.PutIfAbsentRequest(key=b'key', value=p),
+    'replace': lambda p: hotrod.ReplaceRequest(key=b'key', value=p),
+    'replace_if_unmodified': lambda p: hotrod.ReplaceIfUnmodifiedRequest(
+        key=b'key', value=p, version=VERSION),
+    'get': lambda p: hotrod.GetRequest(key=p),
+    'get_with_version': lambda p: hotrod.GetWithVersionRequest(key=p),
+    'get_with_metadata': lambda p: hotrod.GetWithMetadataRequest(key=p),
+    'contains_key': lambda p: hotrod.ContainsKeyRequest(key=p),
+    'remove': lambda p: hotrod.RemoveRequest(key=p),
+    'remove_if_unmodified': lambda p: hotrod.RemoveIfUnmodifiedRequest(
+        key=p, version=VERSION),
+}
+
+REQUESTS_NO_PAYLOAD = {
+    'clear': hotrod.ClearRequest,
+    'stats': hotrod.StatsRequest,
+    'ping': hotrod.PingRequest,
+}
+
+RESPONSES = {
+    'put': lambda h, p: hotrod.PutResponse(
+        header=h(Status.OK_WITH_VALUE), prev_value=p),
+    'put_if_absent': lambda h, p: hotrod.PutIfAbsentResponse(
+        header=h(Status.FAIL_WITH_VALUE), prev_value=p),
+    'replace': lambda h, p: hotrod.ReplaceResponse(
+        header=h(Status.OK_WITH_VALUE), prev_value=p),
+    'replace_if_unmodified': lambda h, p: hotrod.ReplaceIfUnmodifiedResponse(
+        header=h(Status.OK_WITH_VALUE), prev_value=p),
+    'get': lambda h, p: hotrod.GetResponse(header=h(Status.OK), value=p),
+    'get_with_version': lambda h, p: hotrod.GetWithVersionResponse(
+        header=h(Status.OK), version=VERSION, value=p),
+    'get_with_metadata': lambda h, p: hotrod.GetWithMetadataResponse(
+        header=h(Status.OK), flag=0, created=1, lifespan=10, last_used=1,
+        max_idle=10, version=VERSION, value=p),
+    'remove': lambda h, p: hotrod.RemoveResponse(
+        header=h(Status.OK_WITH_VALUE), prev_value=p),
+    'remove_if_unmodified': lambda h, p: hotrod.RemoveIfUnmodifiedResponse(
+        header=h(Status.OK_WITH_VALUE), prev_value=p),
+}
+
+RESPONSES_NO_PAYLOAD = {
+    'contains_key': lambda h: hotrod.ContainsKeyResponse(header=h(Status.OK)),
+    'clear': lambda h: hotrod.ClearResponse(header=h(Status.OK)),
+    'ping': lambda h: hotrod.PingResponse(header=h(Status.OK)),
+    'stats': lambda h: hotrod.StatsResponse(
+        header=h(Status.OK), n=32, stats=[
+            hotrod.Stat(name='stat%d' % i, value=str(i)) for i in range(32)]),
+    'error': lambda h: hotrod.ErrorResponse(
+        header=h(Status.SERVER_ERR), error_message='error'),
+}
+
+HOSTS = [1, 16, 256]
+
+
+def _request(request):
+    request.header.id = 1
+    return request
+
+
+def _header(status, hosts=0):
+    header = hotrod.ResponseHeader(id=1, status=status)
+    if hosts:
+        header.tcm = 1
+        header.tc = hotrod.TopologyChangeHeader(id=1, n=hosts, hosts=[
+            hotrod.Host(ip='10.0.0.%d' % (i % 256), port=11222)
+            for i in range(hosts)])
+    return header
+
+
+class TestEncoder(object):
+    @pytest.fixture
+    def encoder_f(self):
+        return codec.EncoderFactory()
+
+    @pytest.mark.parametrize('size', SIZES)
+    @pytest.mark.parametrize('op', sorted(REQUESTS))
+    def test_encode(self, encoder_f, throughput, op, size):
+        req = _request(REQUESTS[op](b'x' * size))
+        n = len(encoder_f.get().encode(req))
+
+        assert throughput(lambda: encoder_f.get().encode(req, copy=False), n)
+
+    @pytest.mark.parametrize('size', SIZES)
+    def test_encode_buffers(self, encoder_f, throughput, size):
+        req = _request(hotrod.PutRequest(key=b'key', value=b'x' * size))
+        n = len(encoder_f.get().encode(req))
+
+        assert throughput(lambda: encoder_f.get().encode_buffers(req), n)
+
+    @pytest.mark.parametrize('op', sorted(REQUESTS_NO_PAYLOAD))
+    def test_encode_no_payload(self, encoder_f, throughput, op):
+        req = _request(REQUESTS_NO_PAYLOAD[op]())
+        n = len(encoder_f.get().encode(req))
+
+        assert throughput(lambda: encoder_f.get().encode(req, copy=False), n)
+
+    def test_encode_with_template(self, encoder_f, throughput):
+        req = _request(hotrod.GetRequest(key=b'key'))
+        template = codec.HeaderTemplate(req.header)
+        n = len(encoder_f.get().encode(req))
+
+        assert throughput(lambda: encoder_f.get().encode(
+            req, copy=False, template=template), n)
+
+
+class TestDecoder(object):
+    @pytest.fixture
+    def decoder_f(self):
+        return codec.DecoderFactory()
+
+    @pytest.mark.parametrize('size', SIZES)
+    @pytest.mark.parametrize('op', sorted(RESPONSES))
+    def test_decode(self, decoder_f, throughput, op, size):
+        data = codec.Encoder().encode(RESPONSES[op](_header, b'x' * size))
+
+        assert throughput(lambda: decoder_f.get().decode(data), len(data))
+
+    @pytest.mark.parametrize('op', sorted(RESPONSES_NO_PAYLOAD))
+    def test_decode_no_payload(self, decoder_f, throughput, op):
+        data = codec.Encoder().encode(RESPONSES_NO_PAYLOAD[op](_header))
+
+        assert throughput(lambda: decoder_f.get().decode(data), len(data))
+
+    @pytest.mark.parametrize('hosts', HOSTS)
+    def test_decode_topology_change(self, decoder_f, throughput, hosts):
+        data = codec.Encoder().encode(hotrod.PingResponse(
+            header=_header(Status.OK, hosts=hosts)))
+
+        assert throughput(lambda: decoder_f.get().decode(data), len(data))
+
+    @pytest.mark.parametrize('size', SIZES)
+    def test_parse_in_chunks(self, throughput, size):
+        data = codec.Encoder().encode(
+            RESPONSES['get'](_header, b'x' * size))
+        chunks = [data[i:i + 65536] for i in range(0, len(data), 65536)]
+
+        def parse():
+            parser = codec.ResponseParser()
+            for chunk in chunks:
+                responses = parser.feed(chunk)
+            return responses
+
+        assert throughput(parse, len(data))
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from infinispan import hashing
+from infinispan.serial import JSONPickle
+
+
+KEY_SIZES = [8, 16, 64, 256, 4096]
+
+
+def _consistent_hash(hosts=6, segments=256, owners=2):
+    return hashing.ConsistentHash(
+        [("10.0.0.%d" % i, 11222) for i in range(hosts)],
+        [[(s + o) % hosts for o in range(owners)] for s in range(segments)])
+
+
+class TestHashing(object):
+    @pytest.mark.parametrize('size', KEY_SIZES)
+    def test_murmur3(self, throughput, size):
+        key = b'k' * size
+
+        assert throughput(lambda: hashing.murmur3(key), size)
+
+    def test_hash_key_cached(self, throughput):
+        key = JSONPickle().serialize("user:12345678")
+        hashing.hash_key(key)
+
+        assert throughput(lambda: hashing.hash_key(key), len(key))
+
+    def test_primary_owner(self, throughput):
+        ch = _consistent_hash()
+        serial = JSONPickle()
+        keys = [serial.serialize("user:%d" % i) for i in range(10000)]
+        it = iter(keys * 1000)
+
+        assert throughput(lambda: ch.primary_owner(next(it)), len(keys[0]))
+
+    def test_primary_owner_cached(self, throughput):
+        ch = _consistent_hash()
+        key = JSONPickle().serialize("user:12345678")
+
+        assert throughput(lambda: ch.primary_owner(key), len(key))
+
+    @pytest.mark.parametrize('segments', [256, 1024])
+    def test_build_tables(self, benchmark, segments):
+        assert benchmark(_consistent_hash, segments=segments)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import time
+import socket
+import threading
+
+
+class Server(object):
+    """Local TCP server that answers every client with given replies."""
+
+    def __init__(self):
+        self._s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._s.bind(("127.0.0.1", 0))
+        self._s.listen(5)
+        self.port = self._s.getsockname()[1]
+        self.clients = []
+
+    def accept(self):
+        client, _ = self._s.accept()
+        self.clients.append(client)
+        return client
+
+    def reply_later(self, data, delay):
+        def reply():
+            client = self.accept()
+            time.sleep(delay)
+            client.sendall(data)
+        self._start(reply)
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+        self._s.close()
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class HotRodServer(Server):
+    """Local server answering Hot Rod ping and get requests of one client,
+    no key exists. Every response is sent after given delay independently
+    of other requests."""
+
+    def __init__(self, delay=0):
+        super(HotRodServer, self).__init__()
+        self.delay = delay
+        self.requests = 0
+        # (id, cache name) of every request received
+        self.received = []
+        self._lock = threading.Lock()
+
+    def serve(self):
+        self._start(self._serve)
+
+    def _serve(self):
+        client = self.accept()
+        reader = _Reader(client)
+        try:
+            while True:
+                req_id, op = self._read_header(reader)
+                if op == 0x03:
+                    reader.read(reader.uvar())  # key
+                self.requests += 1
+                self._start(self._reply, client, req_id, op)
+        except (socket.error, EOFError):
+            pass
+
+    def _read_header(self, reader):
+        assert reader.byte() == 0xA0
+        req_id = reader.uvar()
+        reader.byte()  # version
+        op = reader.byte()
+        assert op in (0x03, 0x17)  # only gets and pings are supported
+        cname = reader.read(reader.uvar())
+        reader.uvar()  # flags
+        reader.byte()  # client intelligence
+        reader.uvar()  # topology id
+        self.received.append((req_id, cname))
+        return req_id, op
+
+    def _reply(self, client, req_id, op):
+        time.sleep(self.delay)
+        data = bytearray(b'\xa1')
+        while req_id > 0x7F:
+            data.append(req_id & 0x7F | 0x80)
+            req_id >>= 7
+        data.append(req_id)
+        # response op code, ok for pings, key doesn't exist for gets
+        data += bytearray([op + 1, 0x00 if op == 0x17 else 0x02, 0x00])
+        with self._lock:
+            client.sendall(bytes(data))
+
+
+class _Reader(object):
+    def __init__(self, s):
+        self._s = s
+
+    def read(self, n):
+        data = b''
+        while len(data) < n:
+            packet = self._s.recv(n - len(data))
+            if not packet:
+                raise EOFError()
+            data += packet
+        return data
+
+    def byte(self):
+        return bytearray(self.read(1))[0]
+
+    def uvar(self):
+        result = shift = 0
+        while True:
+            b = self.byte()
+            result |= (b & 0x7F) << shift
+            if not b & 0x80:
+                return result
+            shift += 7
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import time
+import socket
+import pytest
+
+from infinispan import connection, error, hotrod
+from infinispan.client import Infinispan
+from tests.unit.server import HotRodServer, Server
+
+
+class TestClient(object):
+    @pytest.yield_fixture
+    def client(self):
+        client = Infinispan()
+        yield client
+        client.executor.shutdown()
+
+    def _topology(self, hf_version):
+        return hotrod.HashTopologyChangeHeader(
+            id=1, n=1, hosts=[hotrod.Host(ip="10.0.0.1", port=11222)],
+            hf_version=hf_version, segments_n=1,
+            segments=[hotrod.Segment(
+                n=1, owners=[hotrod.SegmentOwner(index=0)])])
+
+    def test_create_consistent_hash(self, client):
+        ch = client._create_consistent_hash(self._topology(3))
+
+        assert ch.primary_owner(b'a') == ("10.0.0.1", 11222)
+
+    def test_create_consistent_hash_without_hash(self, client):
+        topology = self._topology(0)
+        topology.segments_n, topology.segments = 0, None
+
+        assert client._create_consistent_hash(topology) is None
+
+    def test_create_consistent_hash_unknown_hash_function(self, client):
+        assert client._create_consistent_hash(self._topology(2)) is None
+
+    def _slow_send(self, req, owner=None):
+        if req == "error":
+            raise error.ConnectionError("Connection reset by peer.")
+        time.sleep(0.1 - 0.03 * req)
+        return req
+
+    def test_send_many_keeps_order(self, client):
+        client._send = self._slow_send
+
+        assert client._send_many([(i, None) for i in range(3)]) == [0, 1, 2]
+
+    def test_send_many_raises_error(self, client):
+        client._send = self._slow_send
+
+        with pytest.raises(error.ConnectionError):
+            client._send_many([(0, None), ("error", None)])
+
+    def test_send_many_in_busy_executor(self):
+        # every thread of the executor waits for requests sent in parallel
+        client = Infinispan(pool_size=1)
+        client._send = self._slow_send
+        f = client.executor.submit(
+            client._send_many, [(i, None) for i in range(3)])
+
+        assert f.result(timeout=1) == [0, 1, 2]
+        client.executor.shutdown()
+
+
+class TestClientRetry(object):
+    @pytest.yield_fixture
+    def live(self):
+        server = HotRodServer()
+        server.serve()
+        yield server
+        server.close()
+
+    @pytest.yield_fixture
+    def dead(self):
+        servers = [Server() for _ in range(2)]
+        for server in servers:
+            server._start(self._hang_up, server)
+        yield servers
+        for server in servers:
+            server.close()
+
+    def _hang_up(self, server):
+        try:
+            while True:
+                server.accept().close()
+        except socket.error:
+            pass
+
+    def _client(self, first, second, timeout=2, **kwargs):
+        client = Infinispan(timeout=timeout, **kwargs)
+        client.protocol.conn = connection.ConnectionPool(
+            [connection.SocketConnection(port=first.port),
+             connection.SocketConnection(port=second.port)],
+            strategy=FirstNode(first.port))
+        sends = []
+        send = client.protocol.send
+
+        def counted_send(*args, **kwargs):
+            sends.append(args[0])
+            return send(*args, **kwargs)
+        client.protocol.send = counted_send
+        return client, sends
+
+    def test_idempotent_request_retried_on_other_node(self, live, dead):
+        client, sends = self._client(dead[0], live)
+
+        assert client.get("key") is None
+        assert len(sends) == 2
+        assert len(live.received) == 1
+        client.disconnect()
+
+    def test_non_idempotent_request_not_retried(self, live, dead):
+        client, sends = self._client(dead[0], live)
+
+        with pytest.raises(error.ConnectionError):
+            client.put_if_absent("key", "value")
+        assert len(sends) == 1
+        assert live.received == []
+        client.disconnect()
+
+    def test_retries_stop_when_budget_exhausted(self, dead):
+        client, sends = self._client(
+            dead[0], dead[1], retry_policy=connection.RetryPolicy(
+                max_attempts=10, max_tokens=4))
+
+        with pytest.raises(error.ConnectionError):
+            client.get("key")
+        assert len(sends) == 2
+        client.disconnect()
+
+    def test_retries_stop_at_deadline(self, dead):
+        client, sends = self._client(
+            dead[0], dead[1], timeout=0.3,
+            retry_policy=connection.RetryPolicy(
+                max_attempts=10**6, max_tokens=10**6))
+        start = time.time()
+
+        with pytest.raises(error.ConnectionError):
+            client.get("key")
+        # stops once no node comes back before the deadline
+        assert time.time() - start < 0.5
+        assert len(sends) > 2
+        client.disconnect()
+
+    def test_retry_waits_for_node_in_backoff(self):
+        server = HotRodServer()
+        # the first connection is dropped, the node is taken out of
+        # selection for a while
+        server._start(lambda: (server.accept().close(), server._serve()))
+        client = Infinispan()
+        client.protocol.conn = connection.ConnectionPool(
+            [connection.SocketConnection(port=server.port)])
+        start = time.time()
+
+        assert client.get("key") is None
+        assert time.time() - start < 1
+        assert len(server.received) == 1
+        client.disconnect()
+        server.close()
+
+    def test_unsent_request_not_charged_to_budget(self, live, dead):
+        client, sends = self._client(live, dead[0], timeout=0.3)
+        for node in client.protocol.conn._nodes:
+            node.retry_at = time.time() + 1
+
+        with pytest.raises(error.UnavailableError):
+            client.get("key")
+        assert len(sends) == 1
+        assert client.retry_policy.tokens == client.retry_policy.max_tokens
+        client.disconnect()
+
+
+class FirstNode(object):
+    """Selection strategy trying the node of given port first."""
+
+    def __init__(self, port):
+        self.port = port
+
+    def order(self, nodes):
+        return sorted(nodes, key=lambda node: node.conn.port != self.port)
@@ -58,6 +58,19 @@ class TestEncoder(object):
             uvarint = 2**(7*5)
             encoder.uvarint(uvarint).result()
 
+    def test_encode_varint(self, encoder):
+        expected = b'\x01\x02\xcf\x0f'
+        actual = encoder.varint(-1).varint(1).varint(-1000).result()
+
+        assert expected == actual
+
+    def test_encode_nullablevarbytes(self, encoder):
+        expected = b'\x01\x08ahoj'
+        actual = encoder.nullablevarbytes(None) \
+            .nullablevarbytes(b'ahoj').result()
+
+        assert expected == actual
+
     def test_encode_uvarlong(self, encoder):
         uvarlong = 2**32
         expected = b'\x80\x80\x80\x80\x10'
@@ -113,51 +126,147 @@ class TestEncoder(object):
 
         assert expected == actual
 
+    def test_encode_with_template(self, encoder):
+        request = hotrod.GetRequest(key=b'ahoj')
+        request.header.id = 1000
+        request.header.cname = u'řcache'
+        request.header.flags = 0x0001
+        request.header.t_id = 130
+        template = codec.HeaderTemplate(request.header)
+        expected = codec.Encoder().encode(request)
+        actual = encoder.encode(request, template=template)
+
+        assert expected == actual
+
+    def test_encode_get_all(self, encoder):
+        expected = b'\xa0\x03\x19\x2f\x00\x00\x01\x00' + \
+            b'\x02\x01a\x02bc'
+        request = hotrod.GetAllRequest(
+            n=2, keys=[hotrod.Key(key=b'a'), hotrod.Key(key=b'bc')])
+        request.header.id = 3
+        actual = encoder.encode(request)
+
+        assert expected == actual
+
+    def test_encode_put_all(self, encoder):
+        expected = b'\xa0\x03\x19\x2d\x00\x00\x01\x00' + \
+            b'\x77\x02\x01a\x04ahoj\x02bc\x00'
+        request = hotrod.PutAllRequest(
+            n=2, entries=[hotrod.Entry(key=b'a', value=b'ahoj'),
+                          hotrod.Entry(key=b'bc', value=b'')])
+        request.header.id = 3
+        actual = encoder.encode(request)
+
+        assert expected == actual
+
+    def test_encode_iteration_start(self, encoder):
+        expected = b'\xa0\x03\x19\x31\x00\x00\x01\x00' + \
+            b'\x02\x05\x01\x0a\x01'
+        request = hotrod.IterationStartRequest(
+            segments=b'\x05', batch_size=10, metadata=1)
+        request.header.id = 3
+        actual = encoder.encode(request)
+
+        assert expected == actual
+
     def test_encode_fail_all_values_not_set(self, encoder):
         with pytest.raises(error.EncodeError):
             rh = hotrod.RequestHeader()
             encoder.encode(rh)
 
+    def test_encode_grows_buffer(self):
+        bytes_ = b'x' * 1000
+        expected = b'\xe8\x07' + bytes_
+        actual = codec.Encoder(size_hint=4).varbytes(bytes_).result()
+
+        assert expected == actual
+
+    def test_encode_without_copy(self, encoder):
+        rh = hotrod.RequestHeader(id=3, op=0x01)
+        expected = b'\xa0\x03\x19\x01\x00\x00\x01\x00'
+        actual = encoder.encode(rh, copy=False)
+
+        assert isinstance(actual, memoryview)
+        assert expected == actual.tobytes()
+
+    def test_encode_buffers(self, encoder):
+        value = b'v' * codec.Encoder.SCATTER_THRESHOLD
+        request = hotrod.PutRequest(key=b'ahoj', value=value)
+        request.header.id = 3
+        expected = codec.Encoder().encode(request)
+        actual = encoder.encode_buffers(request)
+
+        assert len(actual) == 2
+        assert actual[1] is value
+        assert expected == b''.join(memoryview(b).tobytes() for b in actual)
+
+    def test_encode_buffers_small_message(self, encoder):
+        request = hotrod.PutRequest(key=b'ahoj', value=b'value')
+        request.header.id = 3
+        expected = codec.Encoder().encode(request)
+        actual = encoder.encode_buffers(request)
+
+        assert len(actual) == 1
+        assert expected == actual[0].tobytes()
+        assert expected == encoder.reset().encode(request)
+
+    def test_reset(self, encoder):
+        encoder.varbytes(b'ahoj')
+        expected = b'\x33'
+        actual = encoder.reset().byte(0x33).result()
+
+        assert expected == actual
+
+
+class TestEncoderFactory(object):
+
+    def test_get_reuses_encoder(self):
+        encoder_f = codec.EncoderFactory()
+        encoder = encoder_f.get().byte(0x33)
+
+        assert encoder_f.get() is encoder
+        assert encoder.result() == b''
+
 
 class TestDecoder(object):
 
     def test_decode_byte(self):
-        byte = iter('\x33')
+        byte = b'\x33'
         expected = 0x33
         actual = codec.Decoder(byte).byte()
 
         assert expected == actual
 
     def test_decode_bytes(self):
-        bytes_ = iter('ahoj\x76')
+        bytes_ = b'ahoj\x76'
         expected = b'ahoj\x76'
         actual = codec.Decoder(bytes_).bytes(5)
 
         assert expected == actual
 
     def test_decode_varbytes(self):
-        bytes_ = iter('\x05ahoj\x76')
+        bytes_ = b'\x05ahoj\x76'
         expected = b'ahoj\x76'
         actual = codec.Decoder(bytes_).varbytes()
 
         assert expected == actual
 
     def test_decode_splitbyte(self):
-        byte2 = iter('\x76')
+        byte2 = b'\x76'
         expected = [0x07, 0x06]
         actual = codec.Decoder(byte2).splitbyte()
 
         assert expected == actual
 
     def test_decode_ushort(self):
-        short = iter('\x2b\xcb')
+        short = b'\x2b\xcb'
         expected = 11211
         actual = codec.Decoder(short).ushort()
 
         assert expected == actual
 
     def test_decode_uvarint(self):
-        uvarint = iter('\xe8\x07')
+        uvarint = b'\xe8\x07'
         expected = 1000
         actual = codec.Decoder(uvarint).uvarint()
 
@@ -165,11 +274,22 @@ class TestDecoder(object):
 
     def test_decode_uvarint_fail_too_long(self):
         with pytest.raises(error.DecodeError):
-            uvarint = iter('\x80\x80\x80\x80\x80\x01')
+            uvarint = b'\x80\x80\x80\x80\x80\x01'
             codec.Decoder(uvarint).uvarint()
 
+    def test_decode_varint(self):
+        decoder = codec.Decoder(b'\x01\x02\xcf\x0f')
+
+        assert [decoder.varint() for _ in range(3)] == [-1, 1, -1000]
+
+    def test_decode_nullablevarbytes(self):
+        decoder = codec.Decoder(b'\x01\x08ahoj')
+
+        assert decoder.nullablevarbytes() is None
+        assert decoder.nullablevarbytes() == b'ahoj'
+
     def test_decode_uvarlong(self):
-        uvarlong = iter('\x80\x80\x80\x80\x10')
+        uvarlong = b'\x80\x80\x80\x80\x10'
         expected = 2**32
         actual = codec.Decoder(uvarlong).uvarlong()
 
@@ -177,25 +297,25 @@ class TestDecoder(object):
 
     def test_decode_uvarlong_fail_too_long(self):
         with pytest.raises(error.DecodeError):
-            uvarlong = iter('\x80\x80\x80\x80\x80\x80\x80\x80\x80\x01')
+            uvarlong = b'\x80\x80\x80\x80\x80\x80\x80\x80\x80\x01'
             codec.Decoder(uvarlong).uvarlong()
 
     def test_decode_string(self):
-        string = iter('\x04ahoj')
+        string = b'\x04ahoj'
         expected = 'ahoj'
         actual = codec.Decoder(string).string()
 
         assert expected == actual
 
     def test_decode_utf8_string(self):
-        string = iter('\x06\xc5\x99ahoj')
+        string = b'\x06\xc5\x99ahoj'
         expected = u'řahoj'
         actual = codec.Decoder(string).string()
 
         assert expected == actual
 
     def test_decode_long(self):
-        l = iter('\x00\x04\x00\x00\x00\x00\x00\x00')
+        l = b'\x00\x04\x00\x00\x00\x00\x00\x00'
         expected = 1125899906842624
         actual = codec.Decoder(l).long()
 
@@ -203,10 +323,28 @@ class TestDecoder(object):
 
     def test_decode_empty_byte(self):
         with pytest.raises(error.DecodeError):
-            codec.Decoder(iter([''])).byte()
+            codec.Decoder(b'').byte()
+
+    def test_decode_from_generator(self):
+        def recv(data):
+            # behaves like SocketConnection.recv, one byte on start
+            n = 1
+            while data:
+                packet, data = data[:n], data[n:]
+                n = yield packet
+
+        data = recv(b'\xa1\x03\x04\x00\x00\x0aahojahojah')
+        actual = codec.Decoder().decode(data)
+
+        assert actual.header.id == 3
+        assert actual.value == b'ahojahojah'
+
+    def test_decode_from_generator_empty_packet(self):
+        with pytest.raises(error.DecodeError):
+            codec.Decoder(p for p in [b'']).byte()
 
     def test_decode(self):
-        data = iter('\xa1\x03\x04\x00\x00\x04ahoj')
+        data = b'\xa1\x03\x04\x00\x00\x04ahoj'
         expected = hotrod.GetResponse(
             header=hotrod.ResponseHeader(id=3), value=b'ahoj')
         actual = codec.Decoder().decode(data)
@@ -218,11 +356,13 @@ class TestDecoder(object):
         assert expected.header.tcm == actual.header.tcm
         assert expected.value == actual.value
 
+    def test_decode_unknown_op(self):
+        with pytest.raises(error.DecodeError):
+            codec.Decoder().decode(b'\xa1\x03\x03\x00\x00')
+
     def test_decode_with_list(self):
-        data = iter(
-            '\xa1\x03\x04\x00\x01\x03\x02' +
-            '\t127.0.0.1,l\t127.0.0.1+\xd6\x04ahoj'
-        )
+        data = b'\xa1\x03\x04\x00\x01\x03\x02' + \
+            b'\t127.0.0.1,l\t127.0.0.1+\xd6\x04ahoj'
         expected = hotrod.GetResponse(
             header=hotrod.ResponseHeader(
                 id=3, tcm=1, tc=hotrod.TopologyChangeHeader(
@@ -248,3 +388,100 @@ class TestDecoder(object):
         assert expected.header.tc.hosts[1].ip == actual.header.tc.hosts[1].ip
         assert expected.header.tc.hosts[1].port \
             == actual.header.tc.hosts[1].port
+
+    def test_decode_with_hash_topology(self):
+        data = b'\xa1\x03\x04\x00\x01\x03\x02' + \
+            b'\t127.0.0.1,l\t127.0.0.1+\xd6' + \
+            b'\x03\x03\x02\x00\x01\x02\x01\x00\x00' + b'\x04ahoj'
+        actual = codec.Decoder(
+            header_type=hotrod.HashResponseHeader).decode(data)
+
+        tc = actual.header.tc
+        assert tc.n == 2
+        assert tc.hf_version == 3
+        assert tc.segments_n == 3
+        assert [[o.index for o in s.owners] for s in tc.segments] == \
+            [[0, 1], [1, 0], []]
+        assert actual.value == b'ahoj'
+
+    def test_decode_with_hash_topology_without_hash(self):
+        data = b'\xa1\x03\x04\x00\x01\x03\x01' + \
+            b'\t127.0.0.1+\xd6\x00\x00' + b'\x04ahoj'
+        actual = codec.Decoder(
+            header_type=hotrod.HashResponseHeader).decode(data)
+
+        assert actual.header.tc.hf_version == 0
+        assert actual.header.tc.segments_n == 0
+        assert actual.header.tc.segments is None
+        assert actual.value == b'ahoj'
+
+    def test_decode_get_all(self):
+        data = b'\xa1\x03\x30\x00\x00' + \
+            b'\x02\x01a\x04ahoj\x02bc\x00'
+        actual = codec.Decoder().decode(data)
+
+        assert isinstance(actual, hotrod.GetAllResponse)
+        assert actual.n == 2
+        assert [(e.key, e.value) for e in actual.entries] == \
+            [(b'a', b'ahoj'), (b'bc', b'')]
+
+    def test_decode_iteration_next(self):
+        data = b'\xa1\x03\x34\x00\x00' + b'\x01\x05\x02\x01' + \
+            b'\x00\x01a\x04ahoj' + \
+            b'\x01\x03' + b'\x00' * 7 + b'\x02\x02bc\x00'
+        actual = codec.Decoder().decode(data)
+
+        assert isinstance(actual, hotrod.IterationNextResponse)
+        assert actual.finished_segments == b'\x05'
+        assert [(e.key, e.value) for e in actual.entries] == \
+            [(b'a', b'ahoj'), (b'bc', b'')]
+        assert actual.entries[0].version is None
+        assert actual.entries[1].version == b'\x00' * 7 + b'\x02'
+
+    def test_decode_iteration_next_finished(self):
+        actual = codec.Decoder().decode(b'\xa1\x03\x34\x00\x00\x00\x00')
+
+        assert actual.n == 0
+        assert actual.entries == []
+
+
+class TestResponseParser(object):
+
+    @pytest.fixture
+    def parser(self):
+        return codec.ResponseParser()
+
+    def test_feed_whole_response(self, parser):
+        responses = parser.feed(b'\xa1\x03\x04\x00\x00\x04ahoj')
+
+        assert len(responses) == 1
+        assert responses[0].header.id == 3
+        assert responses[0].value == b'ahoj'
+        assert parser.buffered == 0
+
+    def test_feed_byte_by_byte(self, parser):
+        data = b'\xa1\x03\x04\x00\x00\x04ahoj'
+        for i in range(len(data) - 1):
+            assert parser.feed(data[i:i+1]) == []
+
+        responses = parser.feed(data[-1:])
+
+        assert len(responses) == 1
+        assert responses[0].value == b'ahoj'
+
+    def test_feed_multiple_responses(self, parser):
+        data = b'\xa1\x03\x04\x00\x00\x04ahoj' + b'\xa1\x04\x18\x00\x00'
+        responses = parser.feed(data + b'\xa1\x05')
+
+        assert [r.header.id for r in responses] == [3, 4]
+        assert isinstance(responses[1], hotrod.PingResponse)
+        assert parser.buffered == 2
+
+    def test_needed(self, parser):
+        parser.feed(b'\xa1\x03\x04\x00\x00\x0aahoj')
+
+        assert parser.needed == 6
+
+    def test_feed_unknown_op(self, parser):
+        with pytest.raises(error.DecodeError):
+            parser.feed(b'\xa1\x03\xff\x00\x00')
@@ -0,0 +1,635 @@
+# -*- coding: utf-8 -*-
+
+import time
+import socket
+import threading
+import pytest
+
+from infinispan import connection, error
+from tests.unit.server import Server
+
+
+class TestSocketConnection(object):
+    @pytest.yield_fixture
+    def server(self):
+        server = Server()
+        yield server
+        server.close()
+
+    def test_recv_wakes_up_when_data_arrive(self, server):
+        server.reply_later(b'\xa1', 0.01)
+        conn = connection.SocketConnection(port=server.port)
+        conn.connect()
+
+        start = time.time()
+        assert next(conn.recv()) == b'\xa1'
+        assert time.time() - start < 0.04
+        conn.disconnect()
+
+    def test_recv_buffered(self, server):
+        server.reply_later(b'\xa1\x01\xa1\x02', 0)
+        conn = connection.SocketConnection(port=server.port)
+        conn.connect()
+        time.sleep(0.05)
+
+        data = conn.recv()
+        assert next(data) == b'\xa1' and data.send(1) == b'\x01'
+        # rest of the buffer is kept for the next response
+        data = conn.recv()
+        assert next(data) == b'\xa1' and data.send(5) == b'\x02'
+        conn.disconnect()
+
+    def test_recv_larger_than_buffer(self, server):
+        server.reply_later(b'\xa1' + b'x' * 100, 0)
+        conn = connection.SocketConnection(port=server.port, buffer_size=16)
+        conn.connect()
+
+        data = conn.recv()
+        assert next(data) == b'\xa1'
+        received = bytearray()
+        while len(received) < 100:
+            received += data.send(100 - len(received))
+        assert received == b'x' * 100
+        conn.disconnect()
+
+    def test_recv_timeout(self, server):
+        server.reply_later(b'', 0)
+        conn = connection.SocketConnection(port=server.port, timeout=0.1)
+        conn.connect()
+
+        start = time.time()
+        with pytest.raises(error.ConnectionError):
+            next(conn.recv())
+        assert time.time() - start < 1
+        conn.disconnect()
+
+    def test_connection_refused(self, server):
+        server.close()
+        conn = connection.SocketConnection(port=server.port)
+
+        with pytest.raises(error.ConnectionError):
+            conn.connect()
+
+    def test_send_buffers(self, server):
+        conn = connection.SocketConnection(port=server.port)
+        conn.connect()
+        client = server.accept()
+        buffers = [b'\xa0' * 10, memoryview(b'\xa1' * 4 * 1024 * 1024), b'']
+        received = bytearray()
+
+        def read():
+            while len(received) < 4 * 1024 * 1024 + 10:
+                received.extend(client.recv(64 * 1024))
+        reader = threading.Thread(target=read)
+        reader.start()
+        conn.send(buffers)
+        reader.join()
+
+        assert received == b'\xa0' * 10 + b'\xa1' * 4 * 1024 * 1024
+        conn.disconnect()
+
+    def test_send_buffers_partially_written(self):
+        conn = connection.SocketConnection()
+        conn._s = PartialSocket(3)
+        conn.send([b'ahoj', b'', b'x', bytearray(b'svete')])
+
+        assert conn._s.data == b'ahojxsvete'
+
+    def test_send_coalesced(self):
+        conn = connection.SocketConnection(coalesce_delay=0.05)
+        conn._s = PartialSocket(64 * 1024)
+        frames = [b'frame%02d' % i for i in range(20)]
+        threads = [threading.Thread(target=conn.send, args=([frame],))
+                   for frame in frames]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert conn._s.writes < 5
+        assert len(conn._s.data) == 20 * 7
+        assert sorted(frames) == sorted(
+            conn._s.data[i:i + 7] for i in range(0, 20 * 7, 7))
+
+    def test_send_coalesced_flushed_when_full(self):
+        conn = connection.SocketConnection(
+            coalesce_delay=10, coalesce_count=2)
+        conn._s = PartialSocket(64 * 1024)
+        thread = threading.Thread(target=conn.send, args=(b'ahoj',))
+        start = time.time()
+        thread.start()
+        conn.send(b'svete')
+        thread.join()
+
+        assert time.time() - start < 1
+        assert conn._s.writes == 1
+        assert conn._s.data in (b'ahojsvete', b'sveteahoj')
+
+    def test_send_buffers_without_sendmsg(self):
+        conn = connection.SocketConnection()
+        conn._s = SendallSocket(64 * 1024)
+        conn.send([b'ahoj', memoryview(b'xsvete')[1:]])
+
+        assert conn._s.writes == 1
+        assert conn._s.data == b'ahojsvete'
+
+    def test_send_coalesced_without_sendmsg(self):
+        conn = connection.SocketConnection(
+            coalesce_delay=10, coalesce_count=2)
+        conn._s = SendallSocket(64 * 1024)
+        thread = threading.Thread(target=conn.send, args=(b'ahoj',))
+        thread.start()
+        conn.send(b'svete')
+        thread.join()
+
+        assert conn._s.writes == 1
+        assert conn._s.data in (b'ahojsvete', b'sveteahoj')
+
+    def test_send_coalesced_fails_all_senders(self):
+        conn = connection.SocketConnection(coalesce_delay=0.05)
+        conn._s = PartialSocket(0)
+        errors = []
+
+        def send():
+            try:
+                conn.send(b'ahoj')
+            except error.ConnectionError as ex:
+                errors.append(ex)
+        threads = [threading.Thread(target=send) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(errors) == 5
+
+    def test_observe(self):
+        conn = connection.SocketConnection()
+        conn.observe(0.1)
+        assert conn.latency == 0.1
+        conn.observe(0.2)
+        assert 0.1 < conn.latency < 0.2
+
+    def test_socket_options(self, server):
+        conn = connection.SocketConnection(
+            port=server.port, keepalive=True, keepalive_idle=30,
+            keepalive_interval=5, keepalive_count=3, rcvbuf=32 * 1024,
+            sndbuf=32 * 1024)
+        conn.connect()
+
+        s = conn._s
+        assert s.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        assert s.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        assert s.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 32 * 1024
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            assert s.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE) == 30
+        conn.disconnect()
+
+    def test_copy(self):
+        conn = connection.SocketConnection(
+            "example.com", 11333, timeout=5, nodelay=False, keepalive=True,
+            keepalive_idle=30, connect_timeout=1)
+
+        copy = conn.copy()
+        assert copy is not conn
+        assert not copy.connected
+        assert (copy.host, copy.port, copy.timeout, copy.nodelay,
+                copy.keepalive, copy.keepalive_idle, copy.connect_timeout) == \
+            ("example.com", 11333, 5, False, True, 30, 1)
+
+    def test_copy_keeps_type(self):
+        class CustomConnection(connection.SocketConnection):
+            pass
+        conn = CustomConnection("example.com", 11333, timeout=5)
+
+        copy = conn.copy()
+        assert type(copy) is CustomConnection
+        assert (copy.host, copy.port, copy.timeout) == \
+            ("example.com", 11333, 5)
+
+
+class SendallSocket(object):
+    """Socket without scatter-gather sends, as on Python 2, fails if the
+    limit is 0."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = b''
+        self.writes = 0
+
+    def sendall(self, byte_array):
+        if not self.limit:
+            raise socket.error("Broken pipe")
+        self.writes += 1
+        self.data += memoryview(byte_array).tobytes()
+
+
+class PartialSocket(SendallSocket):
+    """Socket that writes at most given number of bytes per send, fails if
+    the limit is 0."""
+
+    def sendmsg(self, buffers):
+        if not self.limit:
+            raise socket.error("Broken pipe")
+        self.writes += 1
+        sent = b''.join(b.tobytes() for b in buffers)[:self.limit]
+        self.data += sent
+        return len(sent)
+
+
+class TestConnectionPool(object):
+    @pytest.yield_fixture
+    def server(self):
+        server = Server()
+        yield server
+        server.close()
+
+    def _pool(self, server, **kwargs):
+        pool = connection.ConnectionPool(
+            [connection.SocketConnection(port=server.port)], **kwargs)
+        pool.connect()
+        return pool
+
+    def test_connect_opens_min_sockets(self, server):
+        pool = self._pool(server, min_size=3, max_size=3)
+
+        assert len(pool._nodes[0].sockets) == 3
+        assert all(s.conn.connected for s in pool._nodes[0].sockets)
+        pool.disconnect()
+
+    def test_checkout_shares_socket(self, server):
+        pool = self._pool(server)
+
+        assert pool.checkout() is pool.checkout()
+        pool.disconnect()
+
+    def test_checkout_grows_lazily(self, server):
+        pool = self._pool(server, max_size=3, max_pending=1)
+
+        conns = [pool.checkout() for _ in range(3)]
+        assert len(set(map(id, conns))) == 3
+        assert len(pool._nodes[0].sockets) == 3
+        pool.disconnect()
+
+    def test_checkout_wakes_waiters_when_shared_socket_connected(
+            self, server):
+        class SlowConnection(connection.SocketConnection):
+            def connect(self):
+                time.sleep(0.2)
+                super(SlowConnection, self).connect()
+        pool = connection.ConnectionPool(
+            [SlowConnection(port=server.port)], min_size=0, wait_timeout=3)
+        pool.connect()
+        waited = []
+
+        def checkout():
+            start = time.time()
+            waited.append((pool.checkout(), time.time() - start))
+        threads = [threading.Thread(target=checkout) for _ in range(2)]
+        holder = threading.Thread(target=lambda: waited.append(
+            (pool.checkout(), 0)))
+        holder.start()
+        time.sleep(0.05)
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        holder.join()
+
+        assert len(set(id(c) for c, _ in waited)) == 1
+        assert all(seconds < 1 for _, seconds in waited)
+        pool.disconnect()
+
+    def test_checkout_timeout_when_exhausted(self, server):
+        pool = self._pool(server, max_size=2, max_pending=1,
+                          wait_timeout=0.05)
+        pool.checkout()
+        pool.checkout()
+
+        with pytest.raises(error.ConnectionError):
+            pool.checkout()
+        pool.disconnect()
+
+    def test_checkout_waits_for_checkin(self, server):
+        pool = self._pool(server, max_pending=1, wait_timeout=1)
+        conn = pool.checkout()
+        timer = threading.Timer(0.05, pool.checkin, args=(conn,))
+        timer.start()
+
+        assert pool.checkout() is conn
+        timer.join()
+        pool.disconnect()
+
+    def test_checkin_reaps_idle_sockets(self, server):
+        pool = self._pool(server, max_size=3, max_pending=1, idle_timeout=0)
+        conns = [pool.checkout() for _ in range(3)]
+        for conn in conns:
+            pool.checkin(conn)
+
+        assert len(pool._nodes[0].sockets) == 1
+        assert conns[0].connected
+        assert not conns[1].connected and not conns[2].connected
+        pool.disconnect()
+
+    def test_context(self, server):
+        pool = self._pool(server, max_pending=1)
+
+        with pool.context() as conn:
+            assert pool._nodes[0].sockets[0].pending == 1
+        assert pool._nodes[0].sockets[0].pending == 0
+        assert conn.connected
+        pool.disconnect()
+
+    def test_checkin_evicts_broken_socket(self, server):
+        pool = self._pool(server, max_pending=1)
+        conn = pool.checkout()
+        conn.broken = True
+        pool.checkin(conn)
+
+        assert pool._nodes[0].sockets == []
+        assert not conn.connected
+        # node is out of selection for longer than the deadline
+        with pytest.raises(error.UnavailableError):
+            pool.checkout(deadline=time.time() + 0.01)
+
+    def test_checkout_reconnects_after_backoff(self, server):
+        pool = self._pool(server, backoff_base=0.01)
+        conn = pool.checkout()
+        conn.broken = True
+        pool.checkin(conn)
+        time.sleep(0.02)
+
+        new_conn = pool.checkout()
+        assert new_conn is not conn
+        assert new_conn.connected
+        assert pool._nodes[0].failures == 0
+        pool.disconnect()
+
+    def test_checkout_waits_for_node_in_backoff(self, server):
+        pool = self._pool(server)
+        pool._nodes[0].retry_at = time.time() + 0.2
+        start = time.time()
+
+        with pool.context(deadline=start + 1) as conn:
+            assert conn.connected
+        assert 0.2 <= time.time() - start < 1
+        pool.disconnect()
+
+    def test_checkout_fails_at_once_if_node_back_after_deadline(self, server):
+        pool = self._pool(server)
+        pool._nodes[0].retry_at = time.time() + 1
+        start = time.time()
+
+        with pytest.raises(error.UnavailableError):
+            pool.checkout(deadline=start + 0.5)
+        assert time.time() - start < 0.1
+        pool.disconnect()
+
+    def test_backoff_grows_with_failures(self, server):
+        pool = self._pool(server, backoff_base=1, backoff_max=3)
+        node = pool._nodes[0]
+        for failures in range(1, 5):
+            pool._fail(node)
+            backoff = node.retry_at - time.time()
+            expected = min(2 ** (failures - 1), 3)
+            assert expected * 0.5 - 0.1 < backoff <= expected
+
+    def test_checkout_skips_failed_node(self, server):
+        pool = connection.ConnectionPool(
+            [connection.SocketConnection(port=server.port) for _ in range(2)])
+        pool.connect()
+        broken = pool.checkout()
+        broken.broken = True
+        pool.checkin(broken)
+        healthy = [n for n in pool._nodes if n.sockets][0].sockets[0].conn
+
+        for _ in range(4):
+            with pool.context() as conn:
+                assert conn is healthy
+        pool.disconnect()
+
+    def test_connect_tolerates_unavailable_node(self, server):
+        down = Server()
+        down.close()
+        pool = connection.ConnectionPool(
+            [connection.SocketConnection(port=down.port),
+             connection.SocketConnection(port=server.port)])
+        pool.connect()
+
+        assert pool.connected
+        with pool.context() as conn:
+            assert conn.port == server.port
+        pool.disconnect()
+
+    def test_connect_fails_when_all_nodes_unavailable(self, server):
+        server.close()
+        pool = connection.ConnectionPool(
+            [connection.SocketConnection(port=server.port)])
+
+        with pytest.raises(error.ConnectionError):
+            pool.connect()
+        assert not pool.connected
+
+    def test_checkout_health_check(self, server):
+        checked = []
+
+        def health_check(conn):
+            checked.append(conn)
+            # only the first connection checked is broken
+            return conn is not checked[0]
+        pool = self._pool(server, health_check=health_check,
+                          health_check_interval=0)
+        time.sleep(0.01)
+
+        conn = pool.checkout()
+        # the stale socket is replaced without taking the node out
+        assert checked == [checked[0]]
+        assert conn is not checked[0]
+        assert conn.connected
+        assert not checked[0].connected
+        assert pool._nodes[0].retry_at == 0
+        assert [s.conn for s in pool._nodes[0].sockets] == [conn]
+        pool.disconnect()
+
+    def test_checkout_health_check_error(self, server):
+        checked = []
+
+        def health_check(conn):
+            checked.append(conn)
+            if len(checked) == 1:
+                raise error.ServerError("Unexpected", None)
+            return True
+        pool = connection.ConnectionPool(
+            [connection.SocketConnection(port=server.port) for _ in range(2)],
+            max_pending=1, health_check=health_check,
+            health_check_interval=0)
+        pool.connect()
+        time.sleep(0.01)
+
+        conn = pool.checkout()
+        assert checked[1] is conn
+        assert not checked[0].connected
+        assert all(s.pending == 0 for n in pool._nodes for s in n.sockets
+                   if s.conn is not conn)
+        pool.disconnect()
+
+    def test_checkout_least_pending(self, server):
+        pool = connection.ConnectionPool(
+            [connection.SocketConnection(port=server.port) for _ in range(2)],
+            strategy=connection.LeastPending())
+        pool.connect()
+
+        first = pool.checkout()
+        second = pool.checkout()
+        assert first is not second
+        pool.checkin(first)
+        assert pool.checkout() is first
+        pool.disconnect()
+
+    def test_checkout_prefers_owner(self, server):
+        pool = connection.ConnectionPool(
+            [connection.SocketConnection(port=server.port),
+             connection.SocketConnection("localhost", server.port)])
+        pool.connect()
+
+        for _ in range(4):
+            with pool.context(owner=("localhost", server.port)) as conn:
+                assert conn.host == "localhost"
+        with pool.context(owner=("10.0.0.1", 11222)) as conn:
+            assert conn.port == server.port
+        pool.disconnect()
+
+    def test_update_connects_new_node_in_background(self, server):
+        pool = self._pool(server, min_size=2, max_size=2)
+        old = pool._nodes[0]
+        new = connection.SocketConnection("localhost", server.port)
+
+        thread = pool.update([old.conn, new])
+        assert pool.size == 2
+        assert pool._nodes[0] is old
+        thread.join()
+        assert not pool._nodes[1].warming
+        assert len(pool._nodes[1].sockets) == 2
+        assert all(s.conn.connected for s in pool._nodes[1].sockets)
+        assert pool.update([old.conn, new]) is None
+        pool.disconnect()
+
+    def test_checkout_skips_warming_node(self, server):
+        pool = self._pool(server)
+        node = connection._Node(
+            connection.SocketConnection("localhost", server.port))
+        node.warming = True
+        pool._nodes.append(node)
+
+        for _ in range(4):
+            with pool.context() as conn:
+                assert conn.host == "127.0.0.1"
+        pool.disconnect()
+
+    def test_update_drains_removed_node(self, server):
+        pool = self._pool(server, max_size=2, max_pending=1)
+        busy = pool.checkout()
+        idle = pool.checkout()
+        pool.checkin(idle)
+        new = connection.SocketConnection("localhost", server.port)
+
+        pool.update([new]).join()
+        assert [n.conn for n in pool._nodes] == [new]
+        assert not idle.connected
+        assert busy.connected
+        with pool.context() as conn:
+            assert conn.host == "localhost"
+        pool.checkin(busy)
+        assert not busy.connected
+        assert not pool._draining
+        pool.disconnect()
+
+
+class Node(object):
+    def __init__(self, name, pending=0, latency=None):
+        self.name = name
+        self.pending = pending
+        self.latency = latency
+
+
+class TestSelectionStrategies(object):
+
+    def test_round_robin(self):
+        nodes = [Node(i) for i in range(3)]
+        strategy = connection.RoundRobin()
+
+        firsts = [strategy.order(nodes)[0].name for _ in range(6)]
+        assert firsts == [0, 1, 2, 0, 1, 2]
+        assert sorted(n.name for n in strategy.order(nodes)) == [0, 1, 2]
+
+    def test_least_pending(self):
+        nodes = [Node(0, pending=3), Node(1, pending=1), Node(2, pending=2)]
+
+        order = connection.LeastPending().order(nodes)
+        assert [n.name for n in order] == [1, 2, 0]
+
+    def test_power_of_two_choices(self):
+        slow, fast = Node(0, latency=0.1), Node(1, latency=0.001)
+
+        for _ in range(10):
+            order = connection.PowerOfTwoChoices().order([slow, fast])
+            assert order == [fast, slow]
+
+    def test_power_of_two_choices_accounts_for_pending(self):
+        busy, idle = Node(0, pending=20, latency=0.001), Node(1, latency=0.01)
+
+        order = connection.PowerOfTwoChoices().order([busy, idle])
+        assert order == [idle, busy]
+
+    def test_power_of_two_choices_returns_all_nodes(self):
+        nodes = [Node(i, latency=0.01) for i in range(5)]
+
+        order = connection.PowerOfTwoChoices().order(nodes)
+        assert sorted(n.name for n in order) == list(range(5))
+
+    def test_weighted_round_robin(self):
+        nodes = [Node(0, latency=0.003), Node(1, latency=0.001)]
+        strategy = connection.WeightedRoundRobin()
+
+        firsts = [strategy.order(nodes)[0].name for _ in range(8)]
+        assert firsts.count(1) == 6
+        assert firsts.count(0) == 2
+
+    def test_weighted_round_robin_custom_weight(self):
+        nodes = [Node(0), Node(1), Node(2)]
+        strategy = connection.WeightedRoundRobin(
+            weight=lambda node: 2 if node.name == 2 else 1)
+
+        firsts = [strategy.order(nodes)[0].name for _ in range(8)]
+        assert firsts.count(2) == 4
+
+
+class TestRetryPolicy(object):
+    def test_attempts_capped(self):
+        policy = connection.RetryPolicy(max_attempts=3)
+        deadline = time.time() + 10
+
+        assert policy.should_retry(1, deadline)
+        assert policy.should_retry(2, deadline)
+        assert not policy.should_retry(3, deadline)
+
+    def test_no_retry_after_deadline(self):
+        policy = connection.RetryPolicy()
+
+        assert not policy.should_retry(1, time.time() - 1)
+
+    def test_budget_throttles_retries(self):
+        policy = connection.RetryPolicy(max_tokens=4, token_ratio=0.5)
+        deadline = time.time() + 10
+
+        assert policy.should_retry(1, deadline)
+        assert not policy.should_retry(1, deadline)
+        for _ in range(3):
+            policy.succeeded()
+        assert policy.should_retry(1, deadline)
+
+    def test_budget_capped(self):
+        policy = connection.RetryPolicy(max_tokens=4)
+        policy.succeeded()
+
+        assert policy.tokens == 4
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from infinispan import hashing
+
+
+class TestMurmur3(object):
+
+    @pytest.mark.parametrize('data, expected', [
+        (b'', 0x054ff222),
+        (b'a', 0xbd49b31c),
+        (b'hello', 0x639adbe8),
+        (b'"key"', 0x13299b4b),
+        (b'infinispan-py rocks!!', 0x72ae6ac1),
+        # whole blocks only, bytes with the highest bit set
+        (bytes(bytearray(range(200, 232))), 0x4b46d224),
+    ])
+    def test_murmur3(self, data, expected):
+        assert hashing.murmur3(data) == expected
+
+    def test_murmur3_accepts_bytearray(self):
+        assert hashing.murmur3(bytearray(b'hello')) == \
+            hashing.murmur3(b'hello')
+
+
+class TestConsistentHash(object):
+
+    @pytest.fixture
+    def ch(self):
+        hosts = [("10.0.0.1", 11222), ("10.0.0.2", 11222)]
+        segments = [[0, 1], [1, 0], [0, 1], []]
+        return hashing.ConsistentHash(hosts, segments)
+
+    def test_segment_size(self, ch):
+        assert ch.segment_size == 0x20000000
+
+    def test_segment(self, ch):
+        # 0x72ae6ac1 & 0x7fffffff == 0x72ae6ac1
+        assert ch.segment(b'infinispan-py rocks!!') == 3
+        # 0xbd49b31c & 0x7fffffff == 0x3d49b31c
+        assert ch.segment(b'a') == 1
+
+    def test_primary_owner(self, ch):
+        assert ch.primary_owner(b'a') == ("10.0.0.2", 11222)
+        assert ch.primary_owner(b'"key"') == ("10.0.0.1", 11222)
+
+    def test_primary_owner_of_segment_without_owners(self, ch):
+        assert ch.primary_owner(b'infinispan-py rocks!!') is None
+
+    def test_primary_owner_without_segments(self):
+        ch = hashing.ConsistentHash([("10.0.0.1", 11222)], [])
+
+        assert ch.primary_owner(b'a') is None
+
+    def test_segment_owner(self, ch):
+        assert ch.segment_owner(0) == ("10.0.0.1", 11222)
+        assert ch.segment_owner(1) == ("10.0.0.2", 11222)
+        assert ch.segment_owner(3) is None
+
+    def test_key_owners(self, ch):
+        assert ch.key_owners(b'a') == [("10.0.0.2", 11222),
+                                       ("10.0.0.1", 11222)]
+        assert ch.key_owners(b'infinispan-py rocks!!') == []
+
+    def test_owner_tables(self, ch):
+        assert list(ch.owners) == [0, 1, 1, 0, 0, 1]
+        assert list(ch.offsets) == [0, 2, 4, 6, 6]
+
+
+class TestHashKey(object):
+
+    def test_hash_key(self):
+        assert hashing.hash_key(b'hello') == 0x639adbe8
+        assert hashing.hash_key(b'hello') == 0x639adbe8
+        assert hashing._hashes.get(b'hello') == 0x639adbe8
+
+    def test_hash_key_not_cached(self):
+        key = b'x' * (hashing.MAX_CACHED_KEY_SIZE + 1)
+
+        assert hashing.hash_key(key) == hashing.murmur3(key)
+        assert hashing.hash_key(bytearray(b'ahoj')) == \
+            hashing.murmur3(b'ahoj')
+        assert hashing._hashes.get(key) is None
+
+
+class TestLRUCache(object):
+
+    def test_get(self):
+        cache = hashing.LRUCache(2)
+        cache.put('a', 1)
+
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert cache.get('b', 2) == 2
+
+    def test_discards_least_recently_used(self):
+        cache = hashing.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        assert len(cache) == 2
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import pytest
+
+from infinispan import connection, error, hotrod
+from tests.unit.server import HotRodServer, Server
+
+
+class TestProtocol(object):
+    @pytest.yield_fixture
+    def server(self):
+        server = HotRodServer(delay=0.1)
+        server.serve()
+        yield server
+        server.close()
+
+    @pytest.yield_fixture
+    def protocol(self, server):
+        conn = connection.SocketConnection(port=server.port)
+        conn.connect()
+        yield hotrod.Protocol(conn, timeout=2)
+        conn.disconnect()
+
+    def test_send(self, protocol):
+        response = protocol.send(hotrod.PingRequest())
+
+        assert isinstance(response, hotrod.PingResponse)
+        assert response.header.id == 1
+        assert protocol.conn.latency >= 0.1
+
+    def test_send_on_given_connection(self, server):
+        conn = connection.SocketConnection(port=server.port)
+        conn.connect()
+        protocol = hotrod.Protocol(connection.ConnectionPool(), timeout=2)
+
+        response = protocol.send(hotrod.PingRequest(), conn=conn)
+
+        assert isinstance(response, hotrod.PingResponse)
+        conn.disconnect()
+
+    def test_send_concurrent_requests_on_one_connection(
+            self, server, protocol):
+        responses = {}
+
+        def ping(i):
+            request = hotrod.PingRequest()
+            responses[i] = (request, protocol.send(request))
+
+        threads = [threading.Thread(target=ping, args=(i,))
+                   for i in range(20)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # all requests are in flight at once, not one after another
+        assert time.time() - start < 1
+        assert server.requests == 20
+        assert len(responses) == 20
+        for request, response in responses.values():
+            assert response.header.id == request.header.id
+        assert protocol._pending == {}
+
+    def test_send_fails_waiting_requests_when_connection_closed(self):
+        server = Server()
+        server.reply_later(b'', 0.1)
+        conn = connection.SocketConnection(port=server.port)
+        conn.connect()
+        protocol = hotrod.Protocol(conn, timeout=2)
+        errors = []
+
+        def ping():
+            try:
+                protocol.send(hotrod.PingRequest())
+            except error.ConnectionError as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=ping) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        server.close()
+        for thread in threads:
+            thread.join()
+
+        assert len(errors) == 5
+        assert protocol._pending == {}
+
+    def test_send_breaks_connection_when_response_undecodable(self):
+        server = Server()
+        server.reply_later(b'\xa1\x01\x03\x00\x00', 0)
+        conn = connection.SocketConnection(port=server.port)
+        conn.connect()
+        protocol = hotrod.Protocol(conn, timeout=2)
+
+        with pytest.raises(error.DecodeError):
+            protocol.send(hotrod.PingRequest())
+        assert conn.broken
+        conn.disconnect()
+        server.close()
+
+    def test_send_drops_responses_of_abandoned_requests(self):
+        server = Server()
+        server.reply_later(b'\xa1\x07\x18\x00\x00\xa1\x01\x18\x00\x00', 0)
+        conn = connection.SocketConnection(port=server.port)
+        conn.connect()
+        protocol = hotrod.Protocol(conn, timeout=2)
+
+        response = protocol.send(hotrod.PingRequest())
+
+        assert response.header.id == 1
+        assert protocol.dropped == 1
+        assert protocol._pending == {}
+        conn.disconnect()
+        server.close()
+
+    def test_send_hands_reading_over_when_reader_times_out(self):
+        server = Server()
+
+        def reply():
+            client = server.accept()
+            # response of an abandoned request wakes the reader up only
+            # after its deadline, the second request is answered later
+            time.sleep(0.4)
+            client.sendall(b'\xa1\x63\x18\x00\x00')
+            time.sleep(0.2)
+            client.sendall(b'\xa1\x02\x18\x00\x00')
+        server._start(reply)
+        conn = connection.SocketConnection(port=server.port)
+        conn.connect()
+        protocol = hotrod.Protocol(conn, timeout=3)
+        errors = []
+
+        def ping_with_timeout():
+            try:
+                protocol.send(hotrod.PingRequest(),
+                              deadline=time.time() + 0.3)
+            except error.ConnectionError as ex:
+                errors.append(ex)
+
+        reader = threading.Thread(target=ping_with_timeout)
+        reader.start()
+        time.sleep(0.05)
+        start = time.time()
+        response = protocol.send(hotrod.PingRequest())
+        reader.join()
+
+        assert len(errors) == 1
+        assert response.header.id == 2
+        assert time.time() - start < 1.5
+        conn.disconnect()
+        server.close()
+
+    def test_send_too_many_pending_requests(self, protocol):
+        protocol.max_pending = 1
+        protocol._pending[99] = None
+
+        with pytest.raises(error.ConnectionError):
+            protocol.send(hotrod.PingRequest())
+        assert list(protocol._pending) == [99]
+
+    def test_send_with_health_check_of_connection(self, server):
+        def health_check(conn):
+            return protocol.send(hotrod.PingRequest(), conn=conn) \
+                .header.status == hotrod.Status.OK
+        pool = connection.ConnectionPool(
+            [connection.SocketConnection(port=server.port)],
+            health_check=health_check, health_check_interval=0)
+        pool.connect()
+        protocol = hotrod.Protocol(pool, timeout=2)
+        time.sleep(0.01)
+
+        request = hotrod.PingRequest()
+        request.header.cname = "outer-cache"
+        response = protocol.send(request)
+
+        assert response.header.id == 1
+        assert server.received == [(2, b''), (1, b'outer-cache')]
+        pool.disconnect()
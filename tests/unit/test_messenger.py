@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from infinispan import messenger as m
+
+
+class Header(m.Message):
+    id = m.Uvarlong()
+    op = m.Byte(default=0x01)
+
+
+class Request(m.Message):
+    header = m.Composite(default=Header)
+    key = m.Varbytes()
+    units = m.SplitByte(default=[0x07, 0x07])
+
+
+class ExtendedRequest(Request):
+    value = m.Varbytes(optional=True)
+
+
+class TestMessage(object):
+    def test_fields_ordered_by_definition(self):
+        assert Request.fields == ['header', 'key', 'units']
+        assert Request().fields == ['header', 'key', 'units']
+
+    def test_fields_inherited(self):
+        assert ExtendedRequest.fields == ['header', 'key', 'units', 'value']
+        assert ExtendedRequest.types['key'] is Request.types['key']
+
+    def test_defaults(self):
+        request = Request(key=b'ahoj')
+
+        assert request.key == b'ahoj'
+        assert request.header.op == 0x01
+        assert request.header.id is None
+
+    def test_mutable_defaults_not_shared(self):
+        request = Request()
+        request.header.id = 1
+        request.units[0] = 0x00
+
+        assert Request().header.id is None
+        assert Request().units == [0x07, 0x07]
+
+    def test_no_instance_dict(self):
+        with pytest.raises(AttributeError):
+            Request().unknown = 1
+
+    def test_cls(self):
+        assert ExtendedRequest().cls is ExtendedRequest
@@ -17,6 +17,12 @@ class TestUTF8(object):
     def test_deserialize(self):
         assert UTF8().deserialize(b'ahoj') == "ahoj"
 
+    def test_serialize_many(self):
+        assert UTF8().serialize_many(["ahoj", "cau"]) == [b'ahoj', b'cau']
+
+    def test_deserialize_many(self):
+        assert UTF8().deserialize_many([b'ahoj', b'']) == ["ahoj", None]
+
 
 class TestJSONPickle(object):
     def test_serialize_string(self):
@@ -30,3 +36,10 @@ class TestJSONPickle(object):
 
     def test_deserialize_int(self):
         assert JSONPickle().deserialize(b'1') == 1
+
+    def test_serialize_many(self):
+        assert JSONPickle().serialize_many(["ahoj", 1]) == [b'"ahoj"', b'1']
+
+    def test_deserialize_many(self):
+        assert JSONPickle().deserialize_many([b'"ahoj"', b'1', None]) == \
+            ["ahoj", 1, None]
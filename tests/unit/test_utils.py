@@ -30,3 +30,8 @@ class TestUtils(object):
             utils.from_pretty_time('10s1')
         with pytest.raises(ValueError):
             utils.from_pretty_time('10ss')
+
+    def test_to_bitset(self):
+        assert utils.to_bitset([]) == b''
+        assert utils.to_bitset([0, 2]) == b'\x05'
+        assert utils.to_bitset([1, 8, 15, 17]) == b'\x02\x81\x02'